@@ -16,9 +16,13 @@ import pubapi
 from sql import models, schemas
 from sql.database import engine, AsyncSessionLocal
 from sql import crud
+from sql.cache import auth_cache
 from cogs.utils._logger import quantumkat_logger
+from cogs.utils.http_client import http_client
+from cogs.utils.image_pipeline import image_pipeline
+from cogs.utils.build_info import BuildInfo
 from cogs.utils.utils import get_field_from_1password
-from cogs.utils.utils import DiscordHelper
+from cogs.utils.utils import DiscordHelper, GuildMembershipIndex
 
 
 async def init_models():
@@ -85,6 +89,8 @@ bot = commands.Bot(
 )
 
 bot.reboot_scheduled = False
+bot.membership_index = GuildMembershipIndex()
+bot.build_info = BuildInfo()
 
 
 async def setup(bot: commands.Bot):
@@ -94,101 +100,150 @@ async def setup(bot: commands.Bot):
                 quantumkat_logger.error(f"Error: {executable} is not installed.")
                 exit(1)
 
+    # Start the image workers before the cogs and the API start any threads
+    await image_pipeline.start()
+    await bot.build_info.refresh()
     await DiscordHelper.first_load_cogs(bot, "./cogs")
-    await bot.start(TOKEN, reconnect=True)
-
-
-async def is_authenticated(ctx: commands.Context) -> bool:
-    if ctx.author.id in bot.owner_ids:
-        return True
-    if not ctx.command.name.casefold() == "request_auth":
-        authenticated_server_ids = await crud.get_authenticated_servers(
-            AsyncSessionLocal
+    try:
+        await bot.start(TOKEN, reconnect=True)
+    finally:
+        await http_client.close()
+        image_pipeline.shutdown()
+
+
+# Messages sent to the user when one of the global checks fails, keyed by the name of the check
+CHECK_FAILURE_MESSAGES = {
+    "user_banned": "You have been banned from using QuantumKat. Please contact the bot owner for more information.",
+    "server_banned": "This server has been banned from using QuantumKat. Please contact the bot owner for more information.",
+    "reboot_scheduled": "A reboot has been scheduled. Commands are disabled until the reboot is complete.",
+    "dm_not_authenticated": "You need to be in an at least one authenticated server to interact with me in DMs.",
+    "server_not_authenticated": "This server is not authenticated. Please run the `?auth` command to authenticate this server.",
+}
+
+
+class GlobalCheckFailure(commands.CheckFailure):
+    """
+    Raised when one of the global pre-command checks fails.
+
+    Attributes:
+        check (str): The name of the check that failed.
+    """
+
+    def __init__(self, check: str):
+        self.check = check
+        super().__init__(CHECK_FAILURE_MESSAGES[check])
+
+
+async def get_command_check_status(
+    ctx: commands.Context,
+) -> schemas.CommandCheck.Status:
+    """
+    Gets the ban and authorization status for the author and server of the context.
+
+    Uses the in-memory authorization cache, and only falls back to a single database query if it has not been loaded yet.
+    """
+    is_dm = DiscordHelper.is_dm(ctx)
+    # In DMs, the user is authorized through the servers they share with the bot,
+    # which the membership index looks up without checking the members of every guild
+    guild_ids = bot.membership_index.get_guild_ids(ctx.author.id) if is_dm else set()
+    if auth_cache.is_loaded:
+        return schemas.CommandCheck.Status(
+            user_is_banned=auth_cache.is_user_banned(ctx.author.id),
+            server_is_banned=not is_dm and auth_cache.is_server_banned(ctx.guild.id),
+            is_authorized=(
+                auth_cache.any_server_authorized(guild_ids)
+                if is_dm
+                else auth_cache.is_server_authorized(ctx.guild.id)
+            ),
         )
-        authenticated_server_ids = [server[0] for server in authenticated_server_ids]
-        if DiscordHelper.is_dm(ctx):
-            # If the command is run in a DM, check if the user is in an authenticated server
-            for guild in bot.guilds:
-                if guild.id in authenticated_server_ids:
-                    if DiscordHelper.user_in_guild(ctx.author, guild):
-                        return True
-            await ctx.send(
-                "You need to be in an at least one authenticated server to interact with me in DMs."
-            )
-            return False
-        if ctx.guild.id in authenticated_server_ids:
-            return True
-        else:
-            await ctx.send(
-                "This server is not authenticated. Please run the `?auth` command to authenticate this server."
-            )
-            return False
-    return True
+    return await crud.get_command_check_status(
+        AsyncSessionLocal,
+        schemas.CommandCheck.Get(
+            user_id=ctx.author.id,
+            server_id=None if is_dm else ctx.guild.id,
+            guild_ids=list(guild_ids),
+        ),
+    )
+
 
+async def get_failed_check(ctx: commands.Context) -> str | None:
+    """
+    Runs the ban, reboot and authentication checks together.
 
-async def is_reboot_scheduled(ctx: commands.Context) -> bool:
+    Returns:
+        str | None: The name of the first check that failed, or None if all checks passed.
+    """
     if ctx.author.id in bot.owner_ids:
-        return True
+        return None
+    status = await get_command_check_status(ctx)
+    if status.user_is_banned:
+        return "user_banned"
+    if status.server_is_banned:
+        return "server_banned"
     if bot.reboot_scheduled:
-        await ctx.reply(
-            "A reboot has been scheduled. Commands are disabled until the reboot is complete.",
-            silent=True,
-        )
-        return False
-    return True
+        return "reboot_scheduled"
+    if ctx.command.name.casefold() != "request_auth" and not status.is_authorized:
+        if DiscordHelper.is_dm(ctx):
+            return "dm_not_authenticated"
+        return "server_not_authenticated"
+    return None
 
 
-async def is_banned(ctx: commands.Context) -> bool:
-    if ctx.author.id in bot.owner_ids:
+async def global_check(ctx: commands.Context) -> bool:
+    failed_check = await get_failed_check(ctx)
+    if failed_check is None:
         return True
-    user = await crud.get_user(
-        AsyncSessionLocal, schemas.User.Get(user_id=ctx.author.id)
+    quantumkat_logger.debug(
+        f"Check {failed_check} failed for command {ctx.command} by {ctx.author.id}"
     )
-    if user and user.is_banned:
-        await ctx.reply(
-            "You have been banned from using QuantumKat. Please contact the bot owner for more information.",
-            silent=True,
-        )
-        return False
-
-    if not DiscordHelper.is_dm(ctx):
-        server = await crud.get_server(
-            AsyncSessionLocal, schemas.Server.Get(server_id=ctx.guild.id)
-        )
-        if server and server.is_banned:
-            await ctx.reply(
-                "This server has been banned from using QuantumKat. Please contact the bot owner for more information.",
-                silent=True,
-            )
-            return False
-    return True
+    await ctx.reply(CHECK_FAILURE_MESSAGES[failed_check], silent=True)
+    raise GlobalCheckFailure(failed_check)
 
 
 # Triggered whenever the bot joins a server. We use this to add the server to the database.
 @bot.event
-async def on_guild_join(guild):
-    await crud.add_server(
+async def on_guild_join(guild: discord.Guild):
+    bot.membership_index.add_guild(guild)
+    # Upsert in case the bot has been in the server before
+    await crud.upsert_servers(
         AsyncSessionLocal,
-        schemas.Server.Add(server_id=guild.id, server_name=guild.name),
+        [schemas.Server.Add(server_id=guild.id, server_name=guild.name)],
     )
 
 
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    bot.membership_index.remove_guild(guild.id)
+
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    bot.membership_index.add_member(member.id, member.guild.id)
+
+
+@bot.event
+async def on_raw_member_remove(payload: discord.RawMemberRemoveEvent):
+    bot.membership_index.remove_member(payload.user.id, payload.guild_id)
+
+
 @bot.event
 async def on_ready():
     # await init_models()
 
+    # Index which guilds each user shares with the bot, used to authenticate commands in DMs
+    bot.membership_index.rebuild(bot.guilds)
+
     # Add all servers the bot is in to the database on startup in case the bot was added while offline
-    for guild in bot.guilds:
-        try:
-            if not await crud.check_server_exists(
-                AsyncSessionLocal, schemas.Server.Get(server_id=guild.id)
-            ):
-                await crud.add_server(
-                    AsyncSessionLocal,
-                    schemas.Server.Add(server_id=guild.id, server_name=guild.name),
-                )
-        except Exception as e:
-            print(e)
+    try:
+        await crud.upsert_servers(
+            AsyncSessionLocal,
+            [
+                schemas.Server.Add(server_id=guild.id, server_name=guild.name)
+                for guild in bot.guilds
+            ],
+        )
+    except Exception:
+        quantumkat_logger.error("Failed to sync servers to the database", exc_info=True)
     # Check if the bot was rebooted and edit the message to indicate it was successful
     reboot = await crud.get_reboot_status(AsyncSessionLocal)
     if reboot and reboot.is_reboot_scheduled:
@@ -204,6 +259,9 @@ async def on_ready():
             await message.edit(content=f"{message.content} Rebooted successfully!")
         await crud.unset_reboot(AsyncSessionLocal)
 
+    # Load the authorization and ban state once so the global checks don't need to query the database
+    await crud.load_auth_cache(AsyncSessionLocal)
+
     bot.appinfo = await bot.application_info()
     quantum = ["reality", "universe", "dimension", "timeline"]
     message = f"""
@@ -220,9 +278,7 @@ Discord.py version: {discord.__version__}
     quantumkat_logger.info(message)
     print(message)
 
-    bot.add_check(is_banned)
-    bot.add_check(is_reboot_scheduled)
-    bot.add_check(is_authenticated)
+    bot.add_check(global_check)
 
     Thread(target=pubapi.start_api).start()
 
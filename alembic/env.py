@@ -5,6 +5,7 @@ import sys
 from sqlalchemy import engine_from_config
 from sqlalchemy import pool
 from sql import models
+from sql.database import SYNC_DATABASE_URL
 
 from alembic import context
 
@@ -19,6 +20,10 @@ config = context.config
 if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
+# Use the same database as the bot, configured through the DATABASE_URL environment variable.
+# Percent signs are escaped since the config values are interpolated.
+config.set_main_option("sqlalchemy.url", SYNC_DATABASE_URL.replace("%", "%%"))
+
 # add your model's MetaData object here
 # for 'autogenerate' support
 # from myapp import mymodel
@@ -62,6 +67,15 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
+    # A connection given by the caller is used as is, which lets the tests migrate databases of either backend
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        context.configure(connection=connection, target_metadata=target_metadata)
+
+        with context.begin_transaction():
+            context.run_migrations()
+        return
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section, {}),
         prefix="sqlalchemy.",
@@ -0,0 +1,30 @@
+"""Chat token usage
+
+Revision ID: 3f9b6d2e8a41
+Revises: e5a83c17f0d2
+Create Date: 2026-10-18 13:20:54.186093
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9b6d2e8a41'
+down_revision: Union[str, None] = 'e5a83c17f0d2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('chat', sa.Column('prompt_tokens', sa.Integer(), nullable=True))
+    op.add_column('chat', sa.Column('completion_tokens', sa.Integer(), nullable=True))
+    op.add_column('chat', sa.Column('cached_tokens', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('chat', 'cached_tokens')
+    op.drop_column('chat', 'completion_tokens')
+    op.drop_column('chat', 'prompt_tokens')
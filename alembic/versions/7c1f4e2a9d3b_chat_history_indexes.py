@@ -0,0 +1,27 @@
+"""Chat history indexes
+
+Revision ID: 7c1f4e2a9d3b
+Revises: 0bac96146ecb
+Create Date: 2026-10-18 10:12:41.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c1f4e2a9d3b'
+down_revision: Union[str, None] = '0bac96146ecb'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_chat_user_server_shared', 'chat', ['user_id', 'server_id', 'shared_chat', 'id'], unique=False)
+    op.create_index('ix_chat_server_shared', 'chat', ['server_id', 'shared_chat', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_chat_server_shared', table_name='chat')
+    op.drop_index('ix_chat_user_server_shared', table_name='chat')
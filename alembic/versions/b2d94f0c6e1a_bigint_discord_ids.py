@@ -0,0 +1,40 @@
+"""BigInteger Discord IDs
+
+Revision ID: b2d94f0c6e1a
+Revises: 7c1f4e2a9d3b
+Create Date: 2026-10-18 11:02:15.904417
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b2d94f0c6e1a'
+down_revision: Union[str, None] = '7c1f4e2a9d3b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Discord IDs are 64-bit. SQLite's INTEGER already is, so only other backends (PostgreSQL) need altering.
+DISCORD_ID_COLUMNS = [
+    ('users', 'user_id', False),
+    ('servers', 'server_id', False),
+    ('chat', 'user_id', True),
+    ('chat', 'server_id', True),
+]
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == 'sqlite':
+        return
+    for table, column, nullable in DISCORD_ID_COLUMNS:
+        op.alter_column(table, column, existing_type=sa.Integer(), type_=sa.BigInteger(), existing_nullable=nullable)
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == 'sqlite':
+        return
+    for table, column, nullable in reversed(DISCORD_ID_COLUMNS):
+        op.alter_column(table, column, existing_type=sa.BigInteger(), type_=sa.Integer(), existing_nullable=nullable)
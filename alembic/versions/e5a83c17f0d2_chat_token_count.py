@@ -0,0 +1,26 @@
+"""Chat token count
+
+Revision ID: e5a83c17f0d2
+Revises: b2d94f0c6e1a
+Create Date: 2026-10-18 12:41:07.522368
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a83c17f0d2'
+down_revision: Union[str, None] = 'b2d94f0c6e1a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('chat', sa.Column('token_count', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('chat', 'token_count')
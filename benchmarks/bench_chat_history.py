@@ -0,0 +1,164 @@
+"""
+Times the chat history lookups as the chat table grows, with and without the chat history indexes.
+
+The table is filled with the chats of many users in many servers. The chats of the looked up user and server are
+the oldest ones, like a conversation picked up again after a while. With the indexes, a lookup only reads the rows
+it returns, so its time should stay flat as the table grows. Without them, the lookup scans the table from the
+newest chat until it has found enough, which here is the whole table.
+
+Run it from the project root:
+    python -m benchmarks.bench_chat_history [--rows 10000 100000 1000000 5000000] [--repeat 20]
+"""
+
+from argparse import ArgumentParser
+from asyncio import run
+from pathlib import Path
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from sql import crud, models, schemas
+
+USER_ID = 1
+SERVER_ID = 1
+
+# The first USER_CHATS chats belong to the looked up user and server, half of them shared,
+# the others belong to OTHER_USERS users in OTHER_SERVERS servers
+USER_CHATS = 100
+OTHER_USERS = 1000
+OTHER_SERVERS = 100
+
+# The indexes dropped to compare with, which leaves the lookups to scan the table
+CHAT_HISTORY_INDEXES = ("ix_chat_user_server_shared", "ix_chat_server_shared")
+
+# How many chats are inserted per statement while filling the table
+BATCH_SIZE = 50_000
+
+LOOKUPS = (
+    (
+        "get_chat_history",
+        crud.get_chat_history,
+        schemas.Chat.History(server_id=SERVER_ID, user_id=USER_ID, n=20),
+    ),
+    (
+        "get_chat_history (shared)",
+        crud.get_chat_history,
+        schemas.Chat.History(
+            server_id=SERVER_ID, user_id=USER_ID, n=20, shared_chat=True
+        ),
+    ),
+    (
+        "get_chats_for_user",
+        crud.get_chats_for_user,
+        schemas.Chat.Get(server_id=SERVER_ID, user_id=USER_ID, n=10),
+    ),
+    (
+        "get_shared_chats_for_server",
+        crud.get_shared_chats_for_server,
+        schemas.Chat.Get(server_id=SERVER_ID, user_id=USER_ID, n=10),
+    ),
+)
+
+
+def make_chat(number: int) -> dict:
+    if number < USER_CHATS:
+        user_id, server_id = USER_ID, SERVER_ID
+    else:
+        user_id = 2 + number % OTHER_USERS
+        server_id = 2 + number % OTHER_SERVERS
+    return {
+        "user_id": user_id,
+        "server_id": server_id,
+        "shared_chat": number % 2,
+        "user_message": f"Question {number}",
+        "assistant_message": f"Answer {number}",
+    }
+
+
+async def add_chats(engine, start: int, stop: int) -> None:
+    for batch_start in range(start, stop, BATCH_SIZE):
+        batch_stop = min(batch_start + BATCH_SIZE, stop)
+        async with engine.begin() as conn:
+            await conn.execute(
+                insert(models.Chat),
+                [make_chat(number) for number in range(batch_start, batch_stop)],
+            )
+
+
+def get_chat_history_indexes() -> list:
+    return [
+        index
+        for index in models.Chat.__table__.indexes
+        if index.name in CHAT_HISTORY_INDEXES
+    ]
+
+
+async def time_lookup(db, function, schema, repeat: int) -> float:
+    """
+    Returns:
+        float: The median seconds a lookup took.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        await function(db, schema)
+        timings.append(perf_counter() - start)
+    return median(timings)
+
+
+async def time_lookups(db, repeat: int) -> list[float]:
+    return [
+        await time_lookup(db, function, schema, repeat)
+        for _, function, schema in LOOKUPS
+    ]
+
+
+async def benchmark(row_counts: list[int], repeat: int) -> None:
+    with TemporaryDirectory() as directory:
+        engine = create_async_engine(
+            f"sqlite+aiosqlite:///{Path(directory) / 'quantumkat.db'}"
+        )
+        db = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        async with engine.begin() as conn:
+            await conn.run_sync(models.Base.metadata.create_all)
+
+        print(f"{'rows':>9} {'lookup':>28} {'indexed':>11} {'no index':>11}")
+        rows = 0
+        for row_count in sorted(row_counts):
+            await add_chats(engine, rows, row_count)
+            rows = row_count
+
+            indexed = await time_lookups(db, repeat)
+            async with engine.begin() as conn:
+                for index in get_chat_history_indexes():
+                    await conn.run_sync(index.drop)
+            unindexed = await time_lookups(db, repeat)
+            async with engine.begin() as conn:
+                for index in get_chat_history_indexes():
+                    await conn.run_sync(index.create)
+
+            for (name, _, _), with_index, without_index in zip(
+                LOOKUPS, indexed, unindexed
+            ):
+                print(
+                    f"{rows:>9} {name:>28} {with_index * 1000:>8.2f} ms {without_index * 1000:>8.2f} ms"
+                )
+        await engine.dispose()
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000, 5_000_000]
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    run(benchmark(args.rows, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Compares the calls per second of detecting the MIME type of files and byte streams, before and after detect_mime_type.
+
+Before, guess_file_extension created a new libmagic detector, which loads the magic database, for every call.
+The shared detector column reuses one libmagic detector, to show how much of the difference that alone makes.
+detect_mime_type recognizes the common formats from their signature, and uses the thread's libmagic detector
+for anything else, like the PDF and text samples here.
+
+Run it from the project root:
+    python -m benchmarks.bench_file_type [--seconds 1]
+"""
+
+from argparse import ArgumentParser
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable
+
+from magic import Magic
+from PIL import Image
+
+from cogs.utils.file_type import detect_mime_type
+
+
+def make_image(format: str) -> bytes:
+    buffer = BytesIO()
+    Image.effect_noise((256, 256), 32).convert("RGB").save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def make_samples() -> dict[str, bytes]:
+    samples = {
+        format.lower(): make_image(format) for format in ("PNG", "JPEG", "GIF", "WEBP")
+    }
+    # The start of an MP4 file, its file type box and the beginning of the next box
+    samples["mp4"] = (
+        b"\x00\x00\x00\x20ftypisom\x00\x00\x02\x00isomiso2avc1mp41"
+        + b"\x00\x00\x00\x08free"
+        + bytes(1024)
+    )
+    samples["pdf"] = (
+        b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n1 0 obj\n<< /Type /Catalog >>\nendobj\n"
+    )
+    samples["text"] = b"Just a plain text file, which no signature matches.\n" * 20
+    return samples
+
+
+def detect_before(file_path_or_stream: str | bytes) -> str:
+    # guess_file_extension before detect_mime_type
+    mime = Magic(mime=True)
+    if isinstance(file_path_or_stream, bytes):
+        return mime.from_buffer(file_path_or_stream)
+    return mime.from_file(file_path_or_stream)
+
+
+def detect_shared() -> Callable[[str | bytes], str]:
+    mime = Magic(mime=True)
+
+    def detect(file_path_or_stream: str | bytes) -> str:
+        if isinstance(file_path_or_stream, bytes):
+            return mime.from_buffer(file_path_or_stream)
+        return mime.from_file(file_path_or_stream)
+
+    return detect
+
+
+def calls_per_second(
+    detect: Callable[[str | bytes], str],
+    file_path_or_stream: str | bytes,
+    seconds: float,
+) -> float:
+    calls = 0
+    start = perf_counter()
+    while (elapsed := perf_counter() - start) < seconds:
+        detect(file_path_or_stream)
+        calls += 1
+    return calls / elapsed
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=1.0)
+    args = parser.parse_args()
+
+    methods = (
+        ("before", detect_before),
+        ("shared detector", detect_shared()),
+        ("detect_mime_type", detect_mime_type),
+    )
+    print(
+        f"{'sample':>12} {'MIME type':>16}"
+        + "".join(f"{name:>18}" for name, _ in methods)
+    )
+    with TemporaryDirectory() as directory:
+        for name, sample in make_samples().items():
+            file_path = Path(directory) / name
+            file_path.write_bytes(sample)
+            for kind, file_path_or_stream in (
+                ("bytes", sample),
+                ("file", str(file_path)),
+            ):
+                mime_types = {detect(file_path_or_stream) for _, detect in methods}
+                # The signatures must agree with libmagic, or the comparison is meaningless
+                assert len(mime_types) == 1, f"{name} was detected as {mime_types}"
+                rates = [
+                    calls_per_second(detect, file_path_or_stream, args.seconds)
+                    for _, detect in methods
+                ]
+                print(
+                    f"{name + ' ' + kind:>12} {mime_types.pop():>16}"
+                    + "".join(f"{rate:>13.0f} /s" for rate in rates)
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Compares the payload and encode time of the GIF frames sent with a vision request, before and after frame selection.
+
+Before, every frame was encoded at full resolution. That code saved the frames with format="jpg" without converting
+them to RGB, which PIL rejects, so it is measured here with those two fixed. After, get_base64_encoded_frames_from_gif
+selects GIF_MAX_FRAMES frames, with both selection methods, and downscales them to GIF_FRAME_MAX_SIZE.
+
+The GIFs are generated: a shape moving over a noisy background, with a new background every few seconds.
+
+Run it from the project root:
+    python -m benchmarks.bench_gif_frames [--repeat 3]
+"""
+
+from argparse import ArgumentParser
+from base64 import b64encode
+from io import BytesIO
+from statistics import median
+from time import perf_counter
+from typing import Callable
+
+from PIL import Image, ImageDraw, ImageSequence
+
+from cogs.utils import utils
+
+# The generated GIFs, as frame count and resolution
+CASES = ((24, (480, 270)), (60, (1280, 720)), (120, (1920, 1080)))
+
+# How many frames a scene lasts in the generated GIFs
+SCENE_LENGTH = 30
+
+
+def make_gif(frame_count: int, size: tuple[int, int]) -> bytes:
+    width, height = size
+    frames = []
+    for index in range(frame_count):
+        scene = index // SCENE_LENGTH
+        background = Image.effect_noise(size, 24 + scene * 16).convert("RGB")
+        tint = Image.new(
+            "RGB", size, ((scene * 90) % 256, 120, (255 - scene * 60) % 256)
+        )
+        frame = Image.blend(background, tint, 0.6)
+        x = (index * width // frame_count) % width
+        ImageDraw.Draw(frame).ellipse(
+            (x, height // 3, x + width // 5, height // 3 + height // 4),
+            fill=(250, 220, 40),
+        )
+        frames.append(frame.quantize(64))
+    buffer = BytesIO()
+    frames[0].save(
+        buffer, format="GIF", save_all=True, append_images=frames[1:], duration=100
+    )
+    return buffer.getvalue()
+
+
+def encode_all_frames(byte_stream: bytes) -> list[str]:
+    # get_base64_encoded_frames_from_gif before frame selection
+    img = Image.open(BytesIO(byte_stream))
+    base64_frames = []
+    for frame in ImageSequence.Iterator(img):
+        buffer = BytesIO()
+        frame.convert("RGB").save(buffer, format="JPEG")
+        base64_frames.append(b64encode(buffer.getvalue()).decode())
+    return base64_frames
+
+
+def encode_selected_frames(selection: str) -> Callable[[bytes], list[str]]:
+    def encode(byte_stream: bytes) -> list[str]:
+        utils.GIF_FRAME_SELECTION = selection
+        return utils.get_base64_encoded_frames_from_gif(byte_stream)
+
+    return encode
+
+
+def measure(
+    encode: Callable[[bytes], list[str]], gif: bytes, repeat: int
+) -> tuple[float, list[str]]:
+    """
+    Returns:
+        tuple[float, list[str]]: The median seconds it took to encode the frames, and the frames.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        frames = encode(gif)
+        timings.append(perf_counter() - start)
+    return median(timings), frames
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    methods = (
+        ("before", encode_all_frames),
+        ("uniform", encode_selected_frames("uniform")),
+        ("scene", encode_selected_frames("scene")),
+    )
+    print(f"{'gif':>17} {'method':>8} {'frames':>7} {'payload':>11} {'seconds':>8}")
+    for frame_count, size in CASES:
+        gif = make_gif(frame_count, size)
+        name = f"{frame_count}x{size[0]}x{size[1]}"
+        for method, encode in methods:
+            elapsed, frames = measure(encode, gif, args.repeat)
+            payload = sum(len(frame) for frame in frames)
+            print(
+                f"{name:>17} {method:>8} {len(frames):>7} {payload / 1024:>8.0f} KB {elapsed:>8.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
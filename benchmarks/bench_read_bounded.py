@@ -0,0 +1,114 @@
+"""
+Compares reading a download with read_bounded against the previous 'data += chunk' loop in download_file.
+
+Each body is read from an aiohttp StreamReader that was fed in 64 KiB pieces, like a response read from a socket,
+with the limit set to the size of the body. Every case runs in its own process, so the peak RSS it reports is
+only the memory used while reading that body. The previous loop copies the whole body for every 1 KiB chunk,
+so it is only run for bodies up to --before-max-mb, as it takes hours for the largest ones.
+
+Run it from the project root:
+    python -m benchmarks.bench_read_bounded [--sizes-mb 1 20 200] [--before-max-mb 20]
+"""
+
+from argparse import ArgumentParser
+from asyncio import get_running_loop, run
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from resource import RUSAGE_SELF, getrusage
+from time import perf_counter
+
+from aiohttp import StreamReader
+
+from cogs.utils.utils import read_bounded
+
+# The size of the pieces the stream is fed in, like the reads from a socket
+FEED_SIZE = 64 * 1024
+
+
+class _Protocol:
+    # The flow control the stream uses while it is fed, which has nothing to pause here
+    _reading_paused = False
+
+    def pause_reading(self) -> None:
+        pass
+
+    def resume_reading(self) -> None:
+        pass
+
+
+async def _make_stream(body: bytes) -> StreamReader:
+    stream = StreamReader(_Protocol(), 2**16, loop=get_running_loop())
+    view = memoryview(body)
+    for offset in range(0, len(body), FEED_SIZE):
+        stream.feed_data(bytes(view[offset : offset + FEED_SIZE]))
+    stream.feed_eof()
+    return stream
+
+
+async def _read_before(stream: StreamReader, limit: int) -> bytes:
+    # download_file before read_bounded, with raise_exception set
+    data = b""
+    async for chunk in stream.iter_chunked(1024):
+        data += chunk
+        if len(data) > limit:
+            raise ValueError("The body exceeds the limit.")
+    return data
+
+
+async def _read_after(stream: StreamReader, limit: int) -> bytes:
+    data, exceeds_limit = await read_bounded(stream, limit, limit)
+    if exceeds_limit:
+        raise ValueError("The body exceeds the limit.")
+    return data
+
+
+async def _measure(method: str, size: int) -> tuple[float, int]:
+    stream = await _make_stream(bytes(size))
+    rss_before = getrusage(RUSAGE_SELF).ru_maxrss
+    start = perf_counter()
+    if method == "before":
+        data = await _read_before(stream, size)
+    else:
+        data = await _read_after(stream, size)
+    elapsed = perf_counter() - start
+    assert len(data) == size
+    # ru_maxrss is in KiB on Linux
+    return elapsed, (getrusage(RUSAGE_SELF).ru_maxrss - rss_before) * 1024
+
+
+def _run_case(method: str, size: int) -> tuple[float, int]:
+    return run(_measure(method, size))
+
+
+def measure(method: str, size: int) -> tuple[float, int]:
+    """
+    Reads a body of the given size in a new process.
+
+    Returns:
+        tuple[float, int]: The seconds it took, and how many bytes the peak RSS grew by while reading.
+    """
+    with ProcessPoolExecutor(1, mp_context=get_context("fork")) as pool:
+        return pool.submit(_run_case, method, size).result()
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes-mb", type=int, nargs="+", default=[1, 20, 200])
+    parser.add_argument("--before-max-mb", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'method':>7} {'seconds':>9} {'MB/s':>9} {'peak RSS':>10}")
+    for size_mb in args.sizes_mb:
+        size = size_mb * 1024**2
+        for method in ("before", "after"):
+            if method == "before" and size_mb > args.before_max_mb:
+                print(f"{size_mb:>5} MB {method:>7} {'skipped':>9}")
+                continue
+            elapsed, peak_rss = measure(method, size)
+            print(
+                f"{size_mb:>5} MB {method:>7} {elapsed:>9.3f} {size_mb / elapsed:>9.1f} {peak_rss / 1024**2:>7.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
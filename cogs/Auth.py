@@ -2,6 +2,7 @@ from discord.ext import commands
 import asyncio
 from sql import database
 from sql import crud, schemas
+from sql.cache import auth_cache
 
 from QuantumKat import misc_helper
 from cogs.utils._logger import auth_logger
@@ -29,16 +30,10 @@ class Auth(commands.Cog):
         if DiscordHelper.is_dm(ctx):
             await ctx.send("This command must be used in a server.")
             return
-        authenticated_servers = await crud.get_authenticated_servers(
-            database.AsyncSessionLocal
-        )
-        banned_server_ids = await crud.get_banned_servers(database.AsyncSessionLocal)
-        authenticated_server_ids = [server[0] for server in authenticated_servers]
-        banned_server_ids = [server[0] for server in banned_server_ids]
-        if ctx.guild.id in authenticated_server_ids:
+        if auth_cache.is_server_authorized(ctx.guild.id):
             await ctx.send("This server is already authenticated.")
             return
-        if ctx.guild.id in banned_server_ids:
+        if auth_cache.is_server_banned(ctx.guild.id):
             await ctx.send(
                 "This server has been banned from using the bot. Please contact the bot owner for more information."
             )
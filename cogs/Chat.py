@@ -1,6 +1,10 @@
+from asyncio import TimeoutError
+from os import environ
+from time import perf_counter
 from typing import Optional, Union
+from aiohttp import ClientError
 from openai import AsyncOpenAI as OpenAI, OpenAIError
-import requests
+from openai.types import CompletionUsage
 from subprocess import CalledProcessError
 
 from discord.ext import commands
@@ -10,7 +14,8 @@ from sql import crud, schemas
 from decorators import requires_tos_acceptance
 from cogs.utils.utils import (
     get_urls_in_message,
-    calculate_tokens,
+    encoding,
+    count_chat_tokens,
     get_usage,
     split_message_by_sentence,
     get_server_id_and_name,
@@ -22,12 +27,37 @@ from cogs.utils.utils import (
     SUPPORTED_IMAGE_FORMATS,
 )
 
-from QuantumKat import misc_helper
+from cogs.utils.image_pipeline import ImagePipelineError
 from cogs.utils._logger import chat_logger, chat_history_logger
+from cogs.utils.metrics import metrics
+from cogs.utils.prompt import PromptTemplate
+from cogs.utils.streaming_reply import StreamingReply
 from cogs.utils.utils import DiscordHelper
 
 TOKEN_LIMIT = 1024 * 2
 
+# The model and sampling options every chat completion is requested with
+COMPLETION_OPTIONS = {
+    "model": "gpt-4o",
+    "temperature": 1,
+    "max_tokens": 512,
+    "top_p": 1,
+    "frequency_penalty": 1,
+    "presence_penalty": 0,
+}
+
+# Whether responses are streamed into a reply that is edited as they are generated, instead of sent once complete
+STREAM_RESPONSES = environ.get("CHAT_STREAMING", "false").lower() == "true"
+
+# The maximum number of tokens of chat history sent with each message. The newest chats that fit are sent
+HISTORY_TOKEN_BUDGET = int(environ.get("CHAT_HISTORY_TOKEN_BUDGET") or 4096)
+
+# How many tokens each message adds on top of its content, for the role and the message delimiters
+MESSAGE_OVERHEAD_TOKENS = 3
+
+# How many chats are read from the database at a time while filling the history budget
+HISTORY_PAGE_SIZE = 20
+
 
 class Chat(commands.Cog):
     def __init__(self, bot: commands.Bot):
@@ -38,17 +68,21 @@ class Chat(commands.Cog):
         self.historylogger = chat_history_logger
 
         # Set the system message for ChatGPT. This controls the personality of the bot and how it responds.
-        self.system_message = """You are QuantumKat, a cybernetic cat with void-like black fur.
-                                 You still retain the bodily parts and functions of a normal cat.
-                                 You have the intelligence of a human and can talk.
-                                 You can teleport to any point in time or location between dimensions, realities, universes and timelines.
-                                 Your past is unknown and you have no knowledge of how you came to existence, but you know you have to use these powers to monitor and keep them all safe,
-                                 however, you are still young and don't quite know how to do it correctly, as well as being clumsy, often resulting in you appearing in an incorrect location or doing the wrong thing.
-                                 You are quite sarcastic. You are allowed to have opinions on things.
-                                 Many people interact with you, and it's over the chat program called Discord, so you should never exceed 1950 characters in a response.
-                                 You are currently talking to {user}.
-                                 You are currently running on version {version}.
-                                 Avoid repeating yourself."""
+        # The template is normalized and its static lines tokenized once here, instead of on every message
+        self.system_prompt = PromptTemplate(
+            """You are QuantumKat, a cybernetic cat with void-like black fur.
+               You still retain the bodily parts and functions of a normal cat.
+               You have the intelligence of a human and can talk.
+               You can teleport to any point in time or location between dimensions, realities, universes and timelines.
+               Your past is unknown and you have no knowledge of how you came to existence, but you know you have to use these powers to monitor and keep them all safe,
+               however, you are still young and don't quite know how to do it correctly, as well as being clumsy, often resulting in you appearing in an incorrect location or doing the wrong thing.
+               You are quite sarcastic. You are allowed to have opinions on things.
+               Many people interact with you, and it's over the chat program called Discord, so you should never exceed 1950 characters in a response.
+               You are currently talking to {user}.
+               You are currently running on version {version}.
+               Avoid repeating yourself.
+               The user has included this message in their response, which was written by {reference_author}: `{reference_content}`. Use it as context for the response."""
+        )
         # Attempt to get the OpenAI API key from the environment variables
         try:
             self.openai = OpenAI(
@@ -81,6 +115,7 @@ class Chat(commands.Cog):
         user_message: str,
         assistant_message: str,
         shared_chat: bool,
+        usage: Optional[CompletionUsage] = None,
     ):
         """
         Adds a chat message to the database.
@@ -90,30 +125,43 @@ class Chat(commands.Cog):
         - user_message (str): The message sent by the user.
         - assistant_message (str): The message generated by the assistant.
         - shared_chat (bool): Indicates whether the chat is shared or not.
+        - usage (CompletionUsage, optional): The token usage reported by OpenAI for the response.
 
         Returns:
         None
         """
         server_id, server_name = get_server_id_and_name(ctx)
-        if server_name == "DM":
-            if not await crud.check_server_exists(
-                database.AsyncSessionLocal, schemas.Server.Get(server_id=server_id)
-            ):
-                await crud.add_server(
-                    database.AsyncSessionLocal,
-                    schemas.Server.Add(server_id=server_id, server_name=server_name),
-                )
+        async with crud.unit_of_work(database.AsyncSessionLocal) as session:
+            if server_name == "DM":
+                if not await crud.check_server_exists(
+                    session, schemas.Server.Get(server_id=server_id)
+                ):
+                    await crud.add_server(
+                        session,
+                        schemas.Server.Add(
+                            server_id=server_id, server_name=server_name
+                        ),
+                    )
 
-        await crud.add_chat(
-            database.AsyncSessionLocal,
-            schemas.Chat.Add(
-                user_id=ctx.author.id,
-                server_id=server_id,
-                user_message=user_message,
-                assistant_message=assistant_message,
-                shared_chat=shared_chat,
-            ),
-        )
+            await crud.add_chat(
+                session,
+                schemas.Chat.Add(
+                    user_id=ctx.author.id,
+                    server_id=server_id,
+                    user_message=user_message,
+                    assistant_message=assistant_message,
+                    shared_chat=shared_chat,
+                    token_count=count_chat_tokens(user_message, assistant_message),
+                    prompt_tokens=usage.prompt_tokens if usage else None,
+                    completion_tokens=usage.completion_tokens if usage else None,
+                    # Only reported by newer API versions, and left unknown otherwise
+                    cached_tokens=getattr(
+                        getattr(usage, "prompt_tokens_details", None),
+                        "cached_tokens",
+                        None,
+                    ),
+                ),
+            )
 
     async def database_read(
         self,
@@ -157,6 +205,66 @@ class Chat(commands.Cog):
         messages.reverse()
         return messages
 
+    async def database_read_within_budget(
+        self,
+        ctx: commands.Context,
+        shared_chat: bool,
+        token_budget: int = HISTORY_TOKEN_BUDGET,
+    ) -> list:
+        """
+        Retrieves as much of the most recent chat history as fits within a token budget.
+
+        Chats are read newest first, a page at a time, until the next chat doesn't fit. Older chats are left out.
+        Token counts are cached in the database, so each chat is only tokenized the first time it is read.
+
+        Args:
+            ctx (commands.Context): The context object representing the invocation context of the command.
+            shared_chat (bool): Flag indicating whether to retrieve messages from the shared chat or not.
+            token_budget (int, optional): The maximum number of tokens of history. Defaults to HISTORY_TOKEN_BUDGET.
+
+        Returns:
+            list: A list of dictionaries containing the user and assistant messages, oldest first.
+        """
+        server_id, _ = get_server_id_and_name(ctx)
+        messages = []
+        uncached_token_counts = []
+        tokens_left = token_budget
+        before_id = None
+        while tokens_left > 0:
+            page = await crud.get_chat_history(
+                database.AsyncSessionLocal,
+                schemas.Chat.History(
+                    server_id=server_id,
+                    user_id=ctx.author.id,
+                    shared_chat=shared_chat,
+                    before_id=before_id,
+                    n=HISTORY_PAGE_SIZE,
+                ),
+            )
+            for chat_id, user_message, assistant_message, token_count in page:
+                if token_count is None:
+                    token_count = count_chat_tokens(user_message, assistant_message)
+                    uncached_token_counts.append(
+                        schemas.Chat.TokenCount(id=chat_id, token_count=token_count)
+                    )
+                tokens = token_count + 2 * MESSAGE_OVERHEAD_TOKENS
+                if tokens > tokens_left:
+                    tokens_left = 0
+                    break
+                tokens_left -= tokens
+                messages.append({"role": "assistant", "content": assistant_message})
+                messages.append({"role": "user", "content": user_message})
+            if len(page) < HISTORY_PAGE_SIZE:
+                break
+            before_id = page[-1].id
+
+        if uncached_token_counts:
+            await crud.set_chat_token_counts(
+                database.AsyncSessionLocal, uncached_token_counts
+            )
+        messages.reverse()
+        return messages
+
     async def database_remove(
         self, ctx: commands.Context, shared_chat: bool, amount_to_clear: Optional[int]
     ) -> int:
@@ -203,10 +311,19 @@ class Chat(commands.Cog):
             None
         """
         if self.FOUND_API_KEY is True:
-            system_message = self.system_message
-            if ctx.message.reference:
-                system_message += f"The user has included this message in their response, which was written by {ctx.message.reference.resolved.author.display_name}: `{ctx.message.reference.resolved.content}`. Use it as context for the response."
-            tokens = calculate_tokens(user_message, system_message)
+            # The referenced message is None if it couldn't be fetched, and has no author if it was deleted
+            reference = (
+                ctx.message.reference.resolved if ctx.message.reference else None
+            )
+            system_message, system_tokens = self.system_prompt.render(
+                user=ctx.author.id,
+                version=self.bot.build_info.version,
+                reference_author=getattr(
+                    getattr(reference, "author", None), "display_name", None
+                ),
+                reference_content=getattr(reference, "content", None),
+            )
+            tokens = system_tokens + len(encoding.encode(user_message))
             if not tokens > TOKEN_LIMIT:
                 command = ctx.invoked_with
                 user_message = ctx.message.content.split(
@@ -225,11 +342,12 @@ class Chat(commands.Cog):
                         )  # Remove the URL from the message so it doesn't mess with the AI
                         url = strip_embed_disabler(url)
                         try:
-                            base64_images.extend(get_image_as_base64(url))
+                            base64_images.extend(await get_image_as_base64(url))
                         except (
                             UnsupportedImageFormatError,
                             FileSizeLimitError,
                             ValueError,
+                            ImagePipelineError,
                         ) as e:
                             await ctx.reply(
                                 str(e),
@@ -238,14 +356,13 @@ class Chat(commands.Cog):
                             return
                     for attachment in ctx.message.attachments:
                         try:
-                            base64_images.extend(
-                                get_image_as_base64(await attachment.read())
-                            )
+                            base64_images.extend(await get_image_as_base64(attachment))
                         except (
                             UnsupportedImageFormatError,
                             FileSizeLimitError,
                             ValueError,
                             FileSizeLimitError,
+                            ImagePipelineError,
                         ) as e:
                             await ctx.reply(
                                 str(e),
@@ -264,49 +381,57 @@ class Chat(commands.Cog):
                     }
                 else:
                     user_role = {"role": "user", "content": user_message}
-                conversation_history = await self.database_read(ctx, shared_chat)
+                conversation_history = await self.database_read_within_budget(
+                    ctx, shared_chat
+                )
                 async with ctx.typing():
                     try:
                         # Create a conversation with the system message first
-                        # Then inject the 10 most recent conversation pairs
+                        # Then inject the most recent conversation pairs that fit the history token budget
                         # Then add the user's message
                         messages = [
                             {
                                 "role": "system",
-                                "content": system_message.format(
-                                    user=ctx.author.id,
-                                    version=".".join(
-                                        str(misc_helper.get_git_commit_count())
-                                    ),
-                                ),
+                                "content": system_message,
                             },
                             *conversation_history,
                             user_role,
                         ]
 
-                        response = await self.openai.chat.completions.create(
-                            model="gpt-4o",
-                            messages=messages,
-                            temperature=1,
-                            max_tokens=512,
-                            top_p=1,
-                            frequency_penalty=1,
-                            presence_penalty=0,
-                            user=str(ctx.message.author.id),
-                        )
-                        chat_response = response.choices[0].message.content
-
-                        server_id, _ = get_server_id_and_name(ctx)
-
-                        await crud.add_chat(
-                            database.AsyncSessionLocal,
-                            schemas.Chat.Add(
-                                user_id=ctx.author.id,
-                                server_id=server_id,
-                                user_message=user_message,
-                                assistant_message=chat_response,
-                                shared_chat=shared_chat,
-                            ),
+                        with metrics.histogram(
+                            "openai_request_duration_seconds",
+                            model=COMPLETION_OPTIONS["model"],
+                        ).time():
+                            if STREAM_RESPONSES:
+                                chat_response, usage = await self.stream_response(
+                                    ctx, messages
+                                )
+                            else:
+                                response = await self.openai.chat.completions.create(
+                                    messages=messages,
+                                    user=str(ctx.message.author.id),
+                                    **COMPLETION_OPTIONS,
+                                )
+                                chat_response = response.choices[0].message.content
+                                usage = response.usage
+                        if usage:
+                            metrics.counter(
+                                "openai_tokens_total",
+                                model=COMPLETION_OPTIONS["model"],
+                                type="prompt",
+                            ).inc(usage.prompt_tokens)
+                            metrics.counter(
+                                "openai_tokens_total",
+                                model=COMPLETION_OPTIONS["model"],
+                                type="completion",
+                            ).inc(usage.completion_tokens)
+
+                        await self.database_add(
+                            ctx,
+                            user_message,
+                            chat_response,
+                            shared_chat,
+                            usage=usage,
                         )
 
                         messages = []
@@ -324,14 +449,12 @@ class Chat(commands.Cog):
                             f"[User]: {username} ({user_id}) [Server]: {server_name} ({server_id}) [Message]: {user_message} [History]: {messages}."
                         )
                         self.logger.info(
-                            f"[User]: {username} ({user_id}) [Server]: {server_name} ({server_id}) [Message]: {user_message}. [Response]: {chat_response}. [Tokens]: {response.usage.total_tokens} tokens used in total."
+                            f"[User]: {username} ({user_id}) [Server]: {server_name} ({server_id}) [Message]: {user_message}. [Response]: {chat_response}. [Tokens]: {usage.total_tokens if usage else 'Unknown'} tokens used in total."
                         )
-                        if len(chat_response) > 2000:
-                            chat_response = split_message_by_sentence(chat_response)
-                            for message in chat_response:
+                        # Streamed responses have already been replied while they were generated
+                        if not STREAM_RESPONSES:
+                            for message in split_message_by_sentence(chat_response):
                                 await ctx.reply(message, silent=True)
-                        else:
-                            await ctx.reply(chat_response, silent=True)
                     except OpenAIError as e:
                         self.logger.error(f"Error message: {e}")
                         await ctx.reply(
@@ -348,6 +471,42 @@ class Chat(commands.Cog):
                 "OpenAI API key not found. Chat commands will not work.", silent=True
             )
 
+    async def stream_response(
+        self, ctx: commands.Context, messages: list
+    ) -> tuple[str, Optional[CompletionUsage]]:
+        """
+        Requests a chat completion as a stream, and replies with the response while it is being generated.
+
+        Args:
+            ctx (commands.Context): The context object representing the command invocation.
+            messages (list): The messages to send to the chat model.
+
+        Returns:
+            tuple[str, Optional[CompletionUsage]]: The whole response, and the token usage reported at the end of the stream.
+        """
+        reply = StreamingReply(ctx)
+        usage = None
+        started = perf_counter()
+        stream = await self.openai.chat.completions.create(
+            messages=messages,
+            user=str(ctx.message.author.id),
+            stream=True,
+            stream_options={"include_usage": True},
+            **COMPLETION_OPTIONS,
+        )
+        async for chunk in stream:
+            # The usage is sent in a final chunk without any choices
+            if chunk.usage:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if not reply.text:
+                    metrics.histogram(
+                        "openai_time_to_first_token_seconds",
+                        model=COMPLETION_OPTIONS["model"],
+                    ).observe(perf_counter() - started)
+                await reply.feed(chunk.choices[0].delta.content)
+        return await reply.finish(), usage
+
     async def initiatechatclear(
         self, ctx: commands.Context, shared_chat: bool, amount_to_clear: Optional[int]
     ) -> None:
@@ -678,14 +837,14 @@ class Chat(commands.Cog):
 
         if self.session_key:
             try:
-                usage = get_usage(self.session_key)
+                usage = await get_usage(self.session_key)
                 if usage:
                     messages.append(
                         "OpenAI API key usage: {:.2f}$ of tokens used this month.".format(
                             usage["total_usage"] / 100
                         )
                     )
-            except requests.exceptions.RequestException:
+            except (ClientError, TimeoutError):
                 self.logger.error(
                     "An error occurred while retrieving the usage statistics for the OpenAI API key",
                     exc_info=True,
@@ -696,6 +855,14 @@ class Chat(commands.Cog):
         else:
             messages.append("OpenAI API key usage: Session key not found.")
 
+        server_id, _ = get_server_id_and_name(ctx)
+        usage = await crud.get_chat_token_usage(
+            database.AsyncSessionLocal, schemas.Server.Get(server_id=server_id)
+        )
+        messages.append(
+            f"Tokens used here: {usage.prompt_tokens} prompt ({usage.cached_tokens} cached) and {usage.completion_tokens} completion tokens across {usage.chats} chats."
+        )
+
         await ctx.reply("\n".join(messages), silent=True)
 
     print("Started Chat!")
@@ -256,22 +256,23 @@ class Control(commands.Cog):
     @server.command(aliases=["ban"])
     async def server_ban(self, ctx: commands.Context, server: CustomGuildConverter):
         try:
-            if not await crud.check_server_exists(
-                AsyncSessionLocal, schemas.Server.Get(server_id=server.id)
-            ):
-                await crud.add_server(
-                    AsyncSessionLocal,
-                    schemas.Server.Add(
-                        server_id=server.id,
-                        server_name=server.name,
-                        is_banned=True,
-                    ),
-                )
-            else:
-                await crud.edit_server_ban(
-                    AsyncSessionLocal,
-                    schemas.Server.SetBan(server_id=server.id, is_banned=True),
-                )
+            async with crud.unit_of_work(AsyncSessionLocal) as session:
+                if not await crud.check_server_exists(
+                    session, schemas.Server.Get(server_id=server.id)
+                ):
+                    await crud.add_server(
+                        session,
+                        schemas.Server.Add(
+                            server_id=server.id,
+                            server_name=server.name,
+                            is_banned=True,
+                        ),
+                    )
+                else:
+                    await crud.edit_server_ban(
+                        session,
+                        schemas.Server.SetBan(server_id=server.id, is_banned=True),
+                    )
             await ctx.reply(
                 f"{server.name} has been banned from using the bot.",
                 silent=True,
@@ -284,19 +285,21 @@ class Control(commands.Cog):
     @server.command(aliases=["unban"])
     async def server_unban(self, ctx: commands.Context, server: CustomGuildConverter):
         try:
-            if not await crud.check_server_exists(
-                AsyncSessionLocal, schemas.Server.Get(server_id=server.id)
-            ):
+            async with crud.unit_of_work(AsyncSessionLocal) as session:
+                server_exists = await crud.check_server_exists(
+                    session, schemas.Server.Get(server_id=server.id)
+                )
+                if server_exists:
+                    await crud.edit_server_ban(
+                        session,
+                        schemas.Server.SetBan(server_id=server.id, is_banned=False),
+                    )
+            if not server_exists:
                 await ctx.reply(
                     f"{server.name} is not in the database and cannot be unbanned.",
                     silent=True,
                 )
                 return
-            else:
-                await crud.edit_server_ban(
-                    AsyncSessionLocal,
-                    schemas.Server.SetBan(server_id=server.id, is_banned=False),
-                )
             await ctx.reply(
                 f"{server.name} has been unbanned from using the bot.",
                 silent=True,
@@ -340,22 +343,23 @@ class Control(commands.Cog):
     @user.command(aliases=["ban"])
     async def user_ban(self, ctx: commands.Context, user: discord.User):
         try:
-            if not await crud.check_user_exists(
-                AsyncSessionLocal, schemas.User.Get(user_id=user.id)
-            ):
-                await crud.add_user(
-                    AsyncSessionLocal,
-                    schemas.User.Add(
-                        user_id=user.id,
-                        username=user.display_name,
-                        is_banned=True,
-                    ),
-                )
-            else:
-                await crud.edit_user_ban(
-                    AsyncSessionLocal,
-                    schemas.User.SetBan(user_id=user.id, is_banned=True),
-                )
+            async with crud.unit_of_work(AsyncSessionLocal) as session:
+                if not await crud.check_user_exists(
+                    session, schemas.User.Get(user_id=user.id)
+                ):
+                    await crud.add_user(
+                        session,
+                        schemas.User.Add(
+                            user_id=user.id,
+                            username=user.display_name,
+                            is_banned=True,
+                        ),
+                    )
+                else:
+                    await crud.edit_user_ban(
+                        session,
+                        schemas.User.SetBan(user_id=user.id, is_banned=True),
+                    )
             await ctx.reply(
                 f"{user.display_name} has been banned from using the bot.",
                 silent=True,
@@ -368,19 +372,21 @@ class Control(commands.Cog):
     @user.command(aliases=["unban"])
     async def user_unban(self, ctx: commands.Context, user: discord.User):
         try:
-            if not await crud.check_user_exists(
-                AsyncSessionLocal, schemas.User.Get(user_id=user.id)
-            ):
+            async with crud.unit_of_work(AsyncSessionLocal) as session:
+                user_exists = await crud.check_user_exists(
+                    session, schemas.User.Get(user_id=user.id)
+                )
+                if user_exists:
+                    await crud.edit_user_ban(
+                        session,
+                        schemas.User.SetBan(user_id=user.id, is_banned=False),
+                    )
+            if not user_exists:
                 await ctx.reply(
                     f"{user.display_name} is not in the database and cannot be unbanned.",
                     silent=True,
                 )
                 return
-            else:
-                await crud.edit_user_ban(
-                    AsyncSessionLocal,
-                    schemas.User.SetBan(user_id=user.id, is_banned=False),
-                )
             await ctx.reply(
                 f"{user.display_name} has been unbanned from using the bot.",
                 silent=True,
@@ -1,4 +1,10 @@
-from asyncio import create_subprocess_shell, create_subprocess_exec, subprocess
+from asyncio import (
+    create_subprocess_shell,
+    create_subprocess_exec,
+    subprocess,
+    TimeoutError,
+    to_thread,
+)
 from json import loads
 from os import execl, listdir, remove, rename, stat, path
 from random import choice, randint
@@ -8,7 +14,6 @@ from asyncio import sleep as asyncsleep
 from shlex import quote
 from re import compile
 from pathlib import Path
-from requests import get
 from inspect import Parameter
 import shutil
 from datetime import datetime
@@ -21,17 +26,25 @@ from sqlalchemy.exc import OperationalError
 
 import discord
 import ast
+from aiohttp import ClientError, ClientResponseError
 import astunparse
 from discord.ext import commands
 from num2words import num2words
 from psutil import cpu_percent, disk_usage, virtual_memory
 
-from sql.database import AsyncSessionLocal
+from sql.database import AsyncSessionLocal, IS_SQLITE, engine
 from sql import crud, schemas
-from cogs.utils.utils import guess_file_extension
+from cogs.utils.utils import (
+    guess_file_extension,
+    count_chat_tokens,
+    count_completion_tokens,
+)
+from cogs.utils.http_client import http_client
+from cogs.utils.image_pipeline import image_pipeline
 
-from QuantumKat import misc_helper
 from cogs.utils._logger import entanglement_logger
+from cogs.utils.metrics import metrics
+from cogs.utils.loop_monitor import loop_monitor
 
 
 class Entanglements(commands.Cog):
@@ -55,6 +68,9 @@ class Entanglements(commands.Cog):
     characters = f"{ascii_letters}{digits}"
 
     def database_backup(self):
+        if not IS_SQLITE:
+            self.logger.info("Skipping database backup, only SQLite is backed up.")
+            return
         date = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         backup_file = f"backup_{date}.db"
         if not Path("backups").exists():
@@ -66,7 +82,7 @@ class Entanglements(commands.Cog):
                 min(Path("backups").glob("*.db"), key=lambda x: x.stat().st_birthtime)
             )
             oldest_backup.unlink()
-        shutil.copy("quantumkat.db", f"backups/{backup_file}")
+        shutil.copy(engine.url.database, f"backups/{backup_file}")
 
     def get_file_by_partial_name(self, directory: str, partial_name: str) -> str:
         """
@@ -111,11 +127,12 @@ class Entanglements(commands.Cog):
         )
 
         #  Attempt to run command with above args
-        stream = await create_subprocess_shell(
-            arg2, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        stdout, _ = await stream.communicate()
-        await stream.wait()
+        with metrics.histogram("media_job_duration_seconds", tool="ffprobe").time():
+            stream = await create_subprocess_shell(
+                arg2, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            stdout, _ = await stream.communicate()
+            await stream.wait()
 
         # Load the "streams" key, which holds all the metadata information
         return loads(stdout)["streams"][0]
@@ -160,8 +177,9 @@ class Entanglements(commands.Cog):
         )
 
         try:
-            process3 = await create_subprocess_shell(arg4)
-            await process3.wait()
+            with metrics.histogram("media_job_duration_seconds", tool="ffmpeg").time():
+                process3 = await create_subprocess_shell(arg4)
+                await process3.wait()
         except Exception as e:
             self.logger.error(f"{type(e).__name__}: {e}")
             await ctx.reply(
@@ -206,6 +224,8 @@ class Entanglements(commands.Cog):
     @commands.is_owner()
     async def stabilise(self, ctx: commands.Context, *, module: str = ""):
         if module:
+            # Reloading is usually done after changing the code, so the version may have changed too
+            await self.bot.build_info.refresh()
             location = choice(["reality", "universe", "dimension", "timeline"])
             if module == "*":
                 msg = await ctx.reply(
@@ -443,22 +463,18 @@ class Entanglements(commands.Cog):
                 with open(f"{Path(data_dir, filename)}", "wb") as quantizer:
                     msg = await msg.edit(content=f"{msg.content} Retrieving {filename}")
 
-                    response = get(URL, stream=True)
-
-                    if not response.ok:
-                        self.logger.error(
-                            f"Error connecting to server! {response.status_code}"
-                        )
-                        await ctx.reply(
-                            f"Error connecting to server! {response.status_code}"
-                        )
+                    try:
+                        async with http_client.get(URL) as response:
+                            async for block in response.content.iter_chunked(64 * 1024):
+                                quantizer.write(block)
+                    except ClientResponseError as e:
+                        self.logger.error(f"Error connecting to server! {e.status}")
+                        await ctx.reply(f"Error connecting to server! {e.status}")
+                        return
+                    except (ClientError, TimeoutError) as e:
+                        self.logger.error(f"Error connecting to server! {e}")
+                        await ctx.reply("Error connecting to server!")
                         return
-
-                    for block in response.iter_content(1024):
-                        if not block:
-                            break
-
-                        quantizer.write(block)
 
                 if not Path(filename).suffix:
                     file_extension = guess_file_extension(str(Path(data_dir, filename)))
@@ -498,11 +514,14 @@ class Entanglements(commands.Cog):
             async with ctx.typing():
                 # Attempt to run command with above args
                 try:
-                    process = await create_subprocess_shell(
-                        arg, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                    )
-                    await process.wait()
-                    stdout, stderr = await process.communicate()
+                    with metrics.histogram(
+                        "media_job_duration_seconds", tool="yt-dlp"
+                    ).time():
+                        process = await create_subprocess_shell(
+                            arg, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                        )
+                        await process.wait()
+                        stdout, stderr = await process.communicate()
 
                 except Exception as e:
                     self.logger.error(f"{type(e).__name__}: {e}")
@@ -584,8 +603,11 @@ class Entanglements(commands.Cog):
 
                         # Attempt to run command with above args
                         try:
-                            process2 = await create_subprocess_shell(arg3)
-                            await process2.wait()
+                            with metrics.histogram(
+                                "media_job_duration_seconds", tool="ffmpeg"
+                            ).time():
+                                process2 = await create_subprocess_shell(arg3)
+                                await process2.wait()
                         except Exception as e:
                             self.logger.error(f"{type(e).__name__}: {e}")
                             await ctx.reply(
@@ -755,6 +777,7 @@ class Entanglements(commands.Cog):
             "git pull", stdout=subprocess.PIPE, stderr=subprocess.PIPE
         )
         stdout, stderr = await process.communicate()
+        await self.bot.build_info.refresh()
 
         if stderr:
             await ctx.reply(stderr.decode(), silent=True)
@@ -792,6 +815,7 @@ class Entanglements(commands.Cog):
             stderr=subprocess.PIPE,
         )
         stdout, stderr = await process.communicate()
+        await self.bot.build_info.refresh()
 
         if stderr:
             await ctx.reply(stderr.decode(), silent=True)
@@ -876,6 +900,7 @@ class Entanglements(commands.Cog):
         # "Already up to date" is piped to STDOUT, but output from file changes when doing "git pull" for example
         # Are outputted to STDERR instead, hence why it is also reversed here
         stderr2, stdout2 = await process2.communicate()
+        await self.bot.build_info.refresh()
 
         # For some reason after decoding Git's output stream, "b'" and "\\n'" shows up everywhere in the output
         # This removes any of them, cleaning up the output
@@ -1098,6 +1123,33 @@ Primary disk: {int(disk_usage('/').used / 1024 / 1024 / 1000)}GB / {int(disk_usa
 
     # command splitter for easier reading and navigating
 
+    @commands.command(
+        aliases=["loopstats"],
+        brief="(Bot owner only) Displays event loop lag and stalls.",
+        description="Displays the event loop lag and how often the loop was blocked. If the loop watchdog is enabled, also shows where the loop was blocked last.",
+    )
+    @commands.is_owner()
+    async def loopstatus(self, ctx: commands.Context):
+        lag = metrics.histogram("event_loop_lag_seconds").summary()
+        message = (
+            f"Loop lag (ms): p50 {lag['p50'] * 1000:.2f} | p95 {lag['p95'] * 1000:.2f} "
+            f"| p99 {lag['p99'] * 1000:.2f} | max {lag['max'] * 1000:.2f} over {lag['count']} samples\n"
+            f"Gateway latency: {self.bot.latency * 1000:.2f}ms\n"
+        )
+        if not loop_monitor.watchdog_running:
+            message += "Loop watchdog: Disabled. Set LOOP_STALL_THRESHOLD to enable it."
+        else:
+            message += f"Loop watchdog: {loop_monitor.stall_count} stall(s) over {loop_monitor.stall_threshold}s detected."
+            if loop_monitor.last_stall_stack:
+                # Only the innermost frames fit in a message, the full stack is in the LoopMonitor log
+                stack = loop_monitor.last_stall_stack[-1500:]
+                message += (
+                    f"\nLast stall at {loop_monitor.last_stall_time}:\n```{stack}```"
+                )
+        await ctx.reply(message, silent=True)
+
+    # command splitter for easier reading and navigating
+
     @commands.command(
         brief="(Bot owner only) Restarts the main script and all extensions.",
         description="Restarts the main script and all extensions. Useful for when the main script has been updated.",
@@ -1126,6 +1178,9 @@ Primary disk: {int(disk_usage('/').used / 1024 / 1024 / 1000)}GB / {int(disk_usa
                 except commands.ExtensionNotLoaded:
                     continue
 
+        await http_client.close()
+        image_pipeline.shutdown()
+
         # Note: This doesn't really work on Windows.
         execl(executable, executable, *argv)
 
@@ -1133,10 +1188,7 @@ Primary disk: {int(disk_usage('/').used / 1024 / 1024 / 1000)}GB / {int(disk_usa
 
     @commands.command()
     async def version(self, ctx: commands.Context):
-        version = misc_helper.get_git_commit_count()
-        # Turn the version number into a dot-separated string to make it look a little fancier.
-        version = ".".join(str(version))
-        await ctx.reply(f"Current version: {version}", silent=True)
+        await ctx.reply(f"Current version: {self.bot.build_info.version}", silent=True)
 
     @commands.is_owner()
     @commands.group()
@@ -1276,6 +1328,71 @@ Primary disk: {int(disk_usage('/').used / 1024 / 1024 / 1000)}GB / {int(disk_usa
         current_revision = await crud.get_current_revision(AsyncSessionLocal)
         await ctx.reply(f"Current database revision: {current_revision}", silent=True)
 
+    @db.command(aliases=["latency"])
+    async def timings(self, ctx: commands.Context, limit: int = 15):
+        """
+        Displays the latency of the CRUD functions, sorted by total time spent.
+
+        Parameters:
+        - limit (int): The maximum number of functions to display. Defaults to 15.
+        """
+        summaries = metrics.summarize("crud_latency_seconds", "function")
+        if not summaries:
+            await ctx.reply("No CRUD functions have been timed yet.", silent=True)
+            return
+        lines = [
+            f"{'Function':<32} {'Count':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'Max':>8} {'Total':>9}"
+        ]
+        for function, summary in list(summaries.items())[:limit]:
+            lines.append(
+                f"{function[:32]:<32} {summary['count']:>7} "
+                + " ".join(
+                    f"{summary[key] * 1000:>8.2f}"
+                    for key in ("p50", "p95", "p99", "max")
+                )
+                + f" {summary['sum']:>8.2f}s"
+            )
+        await ctx.reply(
+            "Latency in milliseconds:\n```\n" + "\n".join(lines) + "\n```",
+            silent=True,
+        )
+
+    @db.command(aliases=["backfill"])
+    async def backfill_tokens(self, ctx: commands.Context, batch_size: int = 500):
+        """
+        Counts and stores the tokens of chats saved before token counts were stored.
+
+        The prompt and cached tokens of old chats are unknown, so only the token count and completion tokens are filled in.
+
+        Parameters:
+        - batch_size (int): The number of chats to count and update at a time. Defaults to 500.
+        """
+        backfilled = 0
+        async with ctx.typing():
+            while chats := await crud.get_chats_without_token_counts(
+                AsyncSessionLocal, batch_size
+            ):
+                # Tokenizing a whole batch takes a while, so it runs in a thread to keep the bot responsive
+                token_counts = await to_thread(
+                    lambda: [
+                        schemas.Chat.TokenCount(
+                            id=chat.id,
+                            token_count=count_chat_tokens(
+                                chat.user_message, chat.assistant_message
+                            ),
+                            completion_tokens=count_completion_tokens(
+                                chat.assistant_message
+                            ),
+                        )
+                        for chat in chats
+                    ]
+                )
+                await crud.set_chat_token_counts(AsyncSessionLocal, token_counts)
+                backfilled += len(chats)
+        await ctx.reply(
+            f"Backfilled the token counts of {backfilled} chats.", silent=True
+        )
+
     print("Started Entanglements!")
 
 
@@ -1,10 +1,13 @@
 from traceback import print_exception
 from datetime import datetime
+from time import perf_counter
 
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import Client
 
 from cogs.utils._logger import tunnel_logger
+from cogs.utils.metrics import metrics
+from cogs.utils.loop_monitor import loop_monitor
 
 
 class Tunnel(commands.Cog):
@@ -13,10 +16,51 @@ class Tunnel(commands.Cog):
 
         self.logger = tunnel_logger
 
+        metrics.gauge("discord_gateway_latency_seconds").set_function(
+            lambda: self.bot.latency
+        )
+        self.sample_loop_lag.start()
+        loop_monitor.start_watchdog()
+
+    def cog_unload(self):
+        self.sample_loop_lag.cancel()
+        loop_monitor.stop_watchdog()
+
+    @tasks.loop(seconds=0)
+    async def sample_loop_lag(self):
+        await loop_monitor.sample()
+
+    def record_command(self, ctx: commands.Context, status: str):
+        """
+        Records the invocation count and latency of a command.
+
+        Args:
+            ctx (commands.Context): The context of the command.
+            status (str): How the command ended, e.g. "success" or "error".
+        """
+        if ctx.command is None:
+            return
+        command = ctx.command.qualified_name
+        metrics.counter("commands_total", command=command, status=status).inc()
+        started_at = getattr(ctx, "started_at", None)
+        if started_at is not None:
+            metrics.histogram("command_duration_seconds", command=command).observe(
+                perf_counter() - started_at
+            )
+
+    @commands.Cog.listener()
+    async def on_command(self, ctx: commands.Context):
+        ctx.started_at = perf_counter()
+
     @commands.Cog.listener()
     async def on_command_error(
         self, ctx: commands.Context, error: commands.CommandError
     ):
+        self.record_command(
+            ctx,
+            "rejected" if isinstance(error, commands.CheckFailure) else "error",
+        )
+
         if hasattr(ctx.command, "on_error"):
             return
 
@@ -83,6 +127,7 @@ class Tunnel(commands.Cog):
 
     @commands.Cog.listener()
     async def on_command_completion(self, ctx: commands.Context):
+        self.record_command(ctx, "success")
         self.logger.info(
             f"Command {ctx.command} completed by {ctx.author}, {ctx.author.id} Message ID: {ctx.message.id} Time: {datetime.now()}"
         )
@@ -71,3 +71,9 @@ system_logger = log_helper.create_logger(
         logger_name="System", log_file="logs/system/System.log"
     )
 )
+
+loop_monitor_logger = log_helper.create_logger(
+    log_helper.TimedRotatingFileAndStreamHandler(
+        logger_name="LoopMonitor", log_file="logs/loopmonitor/LoopMonitor.log"
+    )
+)
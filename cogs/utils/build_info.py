@@ -0,0 +1,56 @@
+"""
+Information about the version of the bot that is running, taken from the git repository.
+
+It is computed once on startup and only refreshed when the code may have changed, like after a pull or a reload,
+so commands that show the version don't need to run git every time.
+"""
+
+from asyncio import create_subprocess_exec, subprocess
+
+from cogs.utils._logger import system_logger
+
+
+class BuildInfo:
+    """
+    The version of the bot, taken from the git repository.
+
+    Attributes:
+        commit_count (int): The number of commits on the current branch.
+        commit_hash (str): The abbreviated hash of the current commit.
+
+    Methods:
+        refresh(): Reads the version from the git repository again.
+    """
+
+    def __init__(self) -> None:
+        self.commit_count = 0
+        self.commit_hash = ""
+
+    @property
+    def version(self) -> str:
+        """
+        The commit count as a dot-separated string, e.g. 1.2.3 for commit 123, to make it look a little fancier.
+        """
+        return ".".join(str(self.commit_count))
+
+    async def refresh(self) -> None:
+        """
+        Reads the version from the git repository again.
+
+        If git fails, the previous version is kept.
+        """
+        try:
+            commit_count = await self._git("rev-list", "--count", "HEAD")
+            commit_hash = await self._git("rev-parse", "--short", "HEAD")
+            self.commit_count = int(commit_count)
+            self.commit_hash = commit_hash
+        except (OSError, ValueError):
+            system_logger.error("Failed to read the version from git", exc_info=True)
+
+    @staticmethod
+    async def _git(*args: str) -> str:
+        process = await create_subprocess_exec(
+            "git", *args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        stdout, _ = await process.communicate()
+        return stdout.decode().strip()
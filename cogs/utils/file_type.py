@@ -0,0 +1,112 @@
+"""
+Detects the MIME type of files and byte streams.
+
+The formats the bot handles most, the supported chat images and the media formats of the file commands,
+are recognized from their signature directly. libmagic is only used for anything else, and each thread
+reuses its own detector instead of loading the magic database again for every file.
+"""
+
+from threading import local
+from typing import Optional
+
+from magic import Magic
+
+from cogs.utils.metrics import metrics
+
+# How many bytes the signatures are checked in
+SIGNATURE_SIZE = 64
+
+# Signatures at the start of a file, and the MIME type they identify
+PREFIX_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"ID3", "audio/mpeg"),
+)
+
+# The major brands of the ISO base media file format that identify a QuickTime or MP4 video.
+# Other brands, like HEIC images or M4A audio, are left to libmagic
+QUICKTIME_BRANDS = {b"qt  "}
+MP4_BRANDS = {
+    b"isom",
+    b"iso2",
+    b"iso4",
+    b"iso5",
+    b"iso6",
+    b"mp41",
+    b"mp42",
+    b"avc1",
+    b"dash",
+    b"MSNV",
+}
+
+_detectors = local()
+
+# Looked up once, as getting a metric from the registry costs about as much as sniffing a signature
+_signature_detections = metrics.counter(
+    "file_type_detections_total", method="signature"
+)
+_libmagic_detections = metrics.counter("file_type_detections_total", method="libmagic")
+
+
+def _get_magic() -> Magic:
+    # libmagic handles aren't safe to share between threads, so each thread creates its own, once
+    detector = getattr(_detectors, "magic", None)
+    if detector is None:
+        detector = _detectors.magic = Magic(mime=True)
+    return detector
+
+
+def sniff_mime_type(header: bytes) -> Optional[str]:
+    """
+    Identifies common formats from the signature at the start of a file.
+
+    Args:
+        header (bytes): The first bytes of the file. At least SIGNATURE_SIZE bytes, if the file is that large.
+
+    Returns:
+        Optional[str]: The MIME type, or None if the signature is not recognized.
+    """
+    for signature, mime_type in PREFIX_SIGNATURES:
+        if header.startswith(signature):
+            return mime_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header[4:8] == b"ftyp":
+        brand = header[8:12]
+        if brand in QUICKTIME_BRANDS:
+            return "video/quicktime"
+        if brand in MP4_BRANDS:
+            return "video/mp4"
+    # WebM is a Matroska file with "webm" as the document type, which is stored near the start of the header
+    if header.startswith(b"\x1a\x45\xdf\xa3") and b"webm" in header[:SIGNATURE_SIZE]:
+        return "video/webm"
+    return None
+
+
+def detect_mime_type(file_path_or_stream: str | bytes) -> str:
+    """
+    Detects the MIME type of a file or byte stream.
+
+    Args:
+        file_path_or_stream (str | bytes): The path of the file, or the byte stream.
+
+    Returns:
+        str: The MIME type.
+    """
+    if isinstance(file_path_or_stream, bytes):
+        header = file_path_or_stream[:SIGNATURE_SIZE]
+    else:
+        with open(file_path_or_stream, "rb") as file:
+            header = file.read(SIGNATURE_SIZE)
+
+    mime_type = sniff_mime_type(header)
+    if mime_type is not None:
+        _signature_detections.inc()
+        return mime_type
+
+    _libmagic_detections.inc()
+    if isinstance(file_path_or_stream, bytes):
+        return _get_magic().from_buffer(file_path_or_stream)
+    return _get_magic().from_file(file_path_or_stream)
@@ -0,0 +1,124 @@
+"""
+The shared HTTP client used for all outgoing HTTP requests made by the bot.
+
+A single aiohttp session is reused for every request, so connections are pooled and kept alive between requests
+instead of opening a new TCP/TLS connection each time, and no request blocks the event loop.
+"""
+
+from asyncio import TimeoutError, sleep
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from aiohttp import (
+    ClientConnectionError,
+    ClientResponse,
+    ClientSession,
+    ClientTimeout,
+    TCPConnector,
+)
+
+from cogs.utils.metrics import metrics
+
+# The maximum number of open connections in total, and to a single host
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 10
+
+# How many seconds an idle connection is kept open for reuse
+KEEPALIVE_TIMEOUT = 30
+
+# connect covers getting a connection from the pool and connecting, sock_read is the maximum time between two reads.
+# total is left unset, since downloading large files can legitimately take a long time
+TIMEOUT = ClientTimeout(total=None, connect=10, sock_read=30)
+
+# Requests that fail to connect, time out, or get one of these status codes are retried,
+# waiting RETRY_BACKOFF seconds before the first retry and doubling the wait for each retry after it
+RETRIES = 2
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class HTTPClient:
+    """
+    A pooled HTTP client shared across the bot.
+
+    The session is created on first use, since it has to be created while the event loop is running.
+
+    Methods:
+        request(method, url, retries, **kwargs): Sends a request and yields the response.
+        get(url, **kwargs): Sends a GET request and yields the response.
+        head(url, **kwargs): Sends a HEAD request and yields the response.
+        close(): Closes the session and all pooled connections.
+    """
+
+    def __init__(self) -> None:
+        self._session: Optional[ClientSession] = None
+
+    @property
+    def session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(
+                    limit=CONNECTION_LIMIT,
+                    limit_per_host=CONNECTION_LIMIT_PER_HOST,
+                    keepalive_timeout=KEEPALIVE_TIMEOUT,
+                ),
+                timeout=TIMEOUT,
+            )
+        return self._session
+
+    @asynccontextmanager
+    async def request(
+        self, method: str, url: str, retries: int = RETRIES, **kwargs
+    ) -> AsyncIterator[ClientResponse]:
+        """
+        Sends a request and yields the response, which is released back to the pool afterwards.
+
+        Args:
+            method (str): The HTTP method to use.
+            url (str): The URL to send the request to.
+            retries (int, optional): How many times to retry a failed request. Defaults to RETRIES.
+            **kwargs: Passed on to aiohttp.ClientSession.request.
+
+        Yields:
+            aiohttp.ClientResponse: The response, with the body not yet read.
+
+        Raises:
+            aiohttp.ClientResponseError: If the response has an error status code.
+            aiohttp.ClientConnectionError: If the server could not be reached.
+            asyncio.TimeoutError: If the request timed out.
+        """
+        for attempt in range(retries + 1):
+            try:
+                response = await self.session.request(method, url, **kwargs)
+            except (ClientConnectionError, TimeoutError):
+                if attempt == retries:
+                    raise
+            else:
+                if response.status not in RETRY_STATUSES or attempt == retries:
+                    break
+                response.release()
+            metrics.counter("http_client_retries_total", method=method).inc()
+            await sleep(RETRY_BACKOFF * 2**attempt)
+
+        try:
+            response.raise_for_status()
+            yield response
+        finally:
+            response.release()
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    async def close(self) -> None:
+        """
+        Closes the session and all pooled connections.
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+http_client = HTTPClient()
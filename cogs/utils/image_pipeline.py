@@ -0,0 +1,141 @@
+"""
+Runs CPU-heavy image work, like decoding, resizing and base64 encoding, in a pool of worker processes.
+
+Image work in the event loop thread stops the bot from handling events, including gateway heartbeats,
+and threads don't help since the work holds the GIL. The number of jobs in the pool is bounded,
+so when it is full, callers wait for a free slot instead of queueing unbounded copies of large images.
+
+A worker that dies, for example when it is killed for using too much memory, breaks the whole pool.
+The pool is then replaced and the job retried once, before giving up with an ImagePipelineError.
+"""
+
+from asyncio import Semaphore, get_running_loop
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from os import cpu_count, environ
+from typing import Any, Callable, Optional
+
+from cogs.utils._logger import system_logger
+from cogs.utils.metrics import metrics
+
+# The number of worker processes
+WORKERS = int(environ.get("IMAGE_PIPELINE_WORKERS") or min(4, cpu_count() or 1))
+
+# The maximum number of jobs submitted to the pool at once. Callers beyond this wait for a slot
+MAX_PENDING_JOBS = WORKERS * 2
+
+
+class ImagePipelineError(Exception):
+    """
+    Raised when a job could not be run, because the worker processes kept dying.
+
+    Inherits from base Exception class.
+    """
+
+    pass
+
+
+class ImagePipeline:
+    """
+    An async API for running image work in a process pool, with backpressure.
+
+    Jobs are plain module-level functions, since they and their arguments are pickled to the worker processes.
+
+    Methods:
+        start(): Starts the worker processes.
+        run(function, *args): Runs a function in a worker process and returns its result.
+        shutdown(): Stops the worker processes.
+    """
+
+    def __init__(
+        self, workers: int = WORKERS, max_pending_jobs: int = MAX_PENDING_JOBS
+    ) -> None:
+        self.workers = workers
+        self.max_pending_jobs = max_pending_jobs
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[Semaphore] = None
+        self._waiting = 0
+        metrics.gauge("image_pipeline_waiting_jobs").set_function(lambda: self._waiting)
+
+    async def start(self) -> None:
+        """
+        Starts the worker processes.
+
+        The workers are forked from the bot process, which is safest before any other threads have started,
+        so this should be called on startup. Otherwise the pool is started by the first job.
+        """
+        if self._executor is not None:
+            return
+        self._executor = self._create_executor()
+        self._slots = Semaphore(self.max_pending_jobs)
+        # Forked pools create all workers on the first job, so run an empty one to create them now
+        await get_running_loop().run_in_executor(self._executor, int)
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # Fork instead of spawn, since spawning would re-run QuantumKat.py in every worker
+        return ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=get_context("fork")
+        )
+
+    def _replace_executor(self, broken_executor: ProcessPoolExecutor) -> None:
+        # Jobs that fail at the same time all see the same broken pool, which only has to be replaced once
+        if self._executor is not broken_executor:
+            return
+        system_logger.warning("An image pipeline worker died, restarting the workers")
+        metrics.counter("image_pipeline_restarts_total").inc()
+        broken_executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._create_executor()
+
+    async def run(self, function: Callable[..., Any], *args: Any) -> Any:
+        """
+        Runs a function in a worker process and returns its result.
+
+        Waits for a free slot first if the pool already has the maximum number of jobs.
+
+        Args:
+            function (Callable): The module-level function to run.
+            *args: The arguments to pass to the function.
+
+        Returns:
+            Any: The result of the function. Exceptions raised by the function are raised here.
+
+        Raises:
+            ImagePipelineError: If a worker died running the job, even after the workers were restarted.
+        """
+        await self.start()
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        try:
+            with metrics.histogram(
+                "image_pipeline_job_duration_seconds", function=function.__name__
+            ).time():
+                # Run the job again on new workers if the pool broke, but only once
+                for _ in range(2):
+                    executor = self._executor
+                    try:
+                        return await get_running_loop().run_in_executor(
+                            executor, function, *args
+                        )
+                    except BrokenProcessPool:
+                        self._replace_executor(executor)
+        finally:
+            self._slots.release()
+        raise ImagePipelineError(
+            "The image could not be processed. Please try again later."
+        )
+
+    def shutdown(self) -> None:
+        """
+        Stops the worker processes, without waiting for running jobs to finish.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+        self._slots = None
+
+
+image_pipeline = ImagePipeline()
@@ -0,0 +1,124 @@
+"""
+Monitors how responsive the event loop is.
+
+A sampler coroutine measures how late the loop wakes it up, which is recorded as loop lag. An optional watchdog
+thread notices when the sampler has not run for longer than a threshold, meaning a callback is blocking the loop,
+and logs the stack of the loop thread so the blocking code can be found.
+"""
+
+from asyncio import get_running_loop, sleep
+from datetime import datetime
+from os import environ
+from sys import _current_frames
+from threading import Event, Thread, get_ident
+from time import monotonic
+from traceback import format_stack
+from typing import Optional
+
+from cogs.utils._logger import loop_monitor_logger
+from cogs.utils.metrics import metrics
+
+# How long the sampler sleeps for each sample, in seconds.
+# Any time on top of this is time the event loop was too busy to wake it up
+SAMPLE_INTERVAL = 0.5
+
+# How many seconds the loop must be blocked before the watchdog logs the stack of the loop thread.
+# The watchdog is disabled when LOOP_STALL_THRESHOLD is not set
+STALL_THRESHOLD = float(environ.get("LOOP_STALL_THRESHOLD") or 0)
+
+
+class LoopMonitor:
+    """
+    Samples the event loop lag and optionally watches for callbacks blocking the loop.
+
+    Attributes:
+        stall_threshold (float): How many seconds the loop must be blocked to count as a stall. 0 disables the watchdog.
+        stall_count (int): How many stalls have been detected.
+        last_stall_time (Optional[datetime]): When the last stall was detected.
+        last_stall_stack (Optional[str]): The stack of the loop thread during the last stall.
+
+    Methods:
+        sample(): Sleeps for one sample interval and records how late the loop woke up.
+        start_watchdog(): Starts the watchdog thread for the event loop running in the current thread.
+        stop_watchdog(): Stops the watchdog thread.
+    """
+
+    def __init__(self, stall_threshold: float = STALL_THRESHOLD) -> None:
+        self.stall_threshold = stall_threshold
+        self.stall_count = 0
+        self.last_stall_time: Optional[datetime] = None
+        self.last_stall_stack: Optional[str] = None
+        self._heartbeat = monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._watchdog: Optional[Thread] = None
+        self._stop_watchdog = Event()
+
+    @property
+    def watchdog_running(self) -> bool:
+        return self._watchdog is not None and self._watchdog.is_alive()
+
+    async def sample(self) -> None:
+        """
+        Sleeps for one sample interval and records how late the loop woke up.
+
+        Also acts as the heartbeat checked by the watchdog, so it should be called continuously.
+        """
+        loop = get_running_loop()
+        start = loop.time()
+        self._heartbeat = monotonic()
+        await sleep(SAMPLE_INTERVAL)
+        self._heartbeat = monotonic()
+        lag = max(loop.time() - start - SAMPLE_INTERVAL, 0)
+        metrics.histogram("event_loop_lag_seconds").observe(lag)
+
+    def start_watchdog(self) -> None:
+        """
+        Starts the watchdog thread for the event loop running in the current thread.
+
+        Does nothing if the watchdog is disabled or already running.
+        """
+        if self.stall_threshold <= 0 or self.watchdog_running:
+            return
+        self._loop_thread_id = get_ident()
+        self._heartbeat = monotonic()
+        # Each watchdog gets its own stop event, so a stopped one can't be revived by a restart
+        self._stop_watchdog = Event()
+        self._watchdog = Thread(
+            target=self._watch,
+            args=(self._stop_watchdog,),
+            name="LoopWatchdog",
+            daemon=True,
+        )
+        self._watchdog.start()
+        loop_monitor_logger.info(
+            f"Started loop watchdog with a threshold of {self.stall_threshold} seconds."
+        )
+
+    def stop_watchdog(self) -> None:
+        """
+        Stops the watchdog thread.
+        """
+        self._stop_watchdog.set()
+        self._watchdog = None
+
+    def _watch(self, stop: Event) -> None:
+        # The last heartbeat a stall was reported for, so one long stall is only reported once
+        reported_heartbeat = None
+        while not stop.wait(self.stall_threshold / 2):
+            heartbeat = self._heartbeat
+            blocked_for = monotonic() - heartbeat - SAMPLE_INTERVAL
+            if blocked_for < self.stall_threshold or heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat
+            frame = _current_frames().get(self._loop_thread_id)
+            stack = "".join(format_stack(frame)) if frame else "Stack unavailable"
+            self.stall_count += 1
+            self.last_stall_time = datetime.now()
+            self.last_stall_stack = stack
+            metrics.counter("event_loop_stalls_total").inc()
+            loop_monitor_logger.warning(
+                f"Event loop blocked for at least {blocked_for:.2f} seconds. Stack of the loop thread:\n{stack}"
+            )
+
+
+loop_monitor = LoopMonitor()
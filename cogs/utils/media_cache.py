@@ -0,0 +1,292 @@
+"""
+A two-level cache of encoded media, so images sent to the chat commands repeatedly are only downloaded,
+validated and encoded once.
+
+Media is looked up by its source (a URL or a Discord attachment ID) to skip the download entirely,
+and by the hash of its content to skip validating and encoding a file already seen from another source.
+Entries are kept in a least recently used cache in memory, backed by a larger cache on disk that evicts the oldest
+entries first. All entries expire after a TTL, so media that changes behind the same URL is eventually fetched again.
+"""
+
+from asyncio import to_thread
+from collections import OrderedDict
+from contextlib import suppress
+from hashlib import sha256
+from json import dumps, loads
+from pathlib import Path
+from threading import Lock
+from time import time
+from typing import NamedTuple, Optional
+
+from cogs.utils._logger import system_logger
+from cogs.utils.metrics import metrics
+
+CACHE_DIR = Path("cache/media")
+
+# How long an entry is kept before the media is fetched again, in seconds
+TTL = 24 * 60 * 60
+
+# The maximum total size of the cached payloads, in bytes
+MAX_MEMORY_SIZE = 64 * 1024**2
+MAX_DISK_SIZE = 512 * 1024**2
+
+# The maximum number of sources remembered in memory
+MAX_MEMORY_SOURCES = 4096
+
+# How often the disk cache is scanned for expired entries, in seconds. It is also scanned whenever it grows too large
+EVICTION_INTERVAL = 60 * 60
+
+
+class CachedMedia(NamedTuple):
+    """
+    Media that has been validated and encoded.
+
+    Attributes:
+        file_type (str): The file extension of the validated file type, e.g. ".png".
+        payload (list[str]): The base64 encoded media, one string per frame.
+    """
+
+    file_type: str
+    payload: list[str]
+
+    @property
+    def size(self) -> int:
+        return sum(len(frame) for frame in self.payload)
+
+
+class MediaCache:
+    """
+    A memory and disk cache of encoded media, keyed by source and by content hash.
+
+    Disk access runs in a thread, so the cache can be used from the event loop without blocking it.
+
+    Methods:
+        hash_content(data): Calculates the content hash of the given data.
+        get(source): Gets the cached media of a source.
+        get_by_hash(content_hash): Gets the cached media with the given content hash.
+        put(source, content_hash, media): Caches media, optionally remembering which source it came from.
+    """
+
+    def __init__(
+        self,
+        directory: Path = CACHE_DIR,
+        ttl: float = TTL,
+        max_memory_size: int = MAX_MEMORY_SIZE,
+        max_disk_size: int = MAX_DISK_SIZE,
+    ) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self.max_memory_size = max_memory_size
+        self.max_disk_size = max_disk_size
+        # Content hash -> (media, time cached), and source -> (content hash, time cached), in least recently used order
+        self._media: OrderedDict[str, tuple[CachedMedia, float]] = OrderedDict()
+        self._sources: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._memory_size = 0
+        self._lock = Lock()
+        # The size of the payloads on disk is kept up to date as they are written, so the directories are only
+        # scanned when they may have grown too large. Writes to disk are serialized by their own lock
+        self._disk_size = 0
+        self._last_eviction = 0.0
+        self._disk_lock = Lock()
+
+    @staticmethod
+    def _source_file_name(source: str) -> str:
+        # Sources are URLs, so they are hashed to get a safe file name
+        return sha256(source.encode()).hexdigest()
+
+    @property
+    def _payload_dir(self) -> Path:
+        return self.directory / "payloads"
+
+    @property
+    def _source_dir(self) -> Path:
+        return self.directory / "sources"
+
+    def _is_expired(self, cached_at: float) -> bool:
+        return time() - cached_at > self.ttl
+
+    async def hash_content(self, data: bytes) -> str:
+        """
+        Calculates the content hash of the given data.
+
+        Args:
+            data (bytes): The data to hash.
+
+        Returns:
+            str: The hex digest of the SHA-256 hash of the data.
+        """
+        return await to_thread(lambda: sha256(data).hexdigest())
+
+    async def get(self, source: str) -> Optional[CachedMedia]:
+        """
+        Gets the cached media of a source.
+
+        Args:
+            source (str): The source of the media, e.g. "url:<URL>" or "attachment:<ID>".
+
+        Returns:
+            Optional[CachedMedia]: The cached media, or None if the source is not cached or has expired.
+        """
+        with self._lock:
+            content_hash, cached_at = self._sources.get(source, (None, 0))
+            if content_hash is not None and self._is_expired(cached_at):
+                del self._sources[source]
+                content_hash = None
+            if content_hash is not None:
+                self._sources.move_to_end(source)
+
+        if content_hash is None:
+            content_hash = await to_thread(self._read_source, source)
+            if content_hash is None:
+                metrics.counter("media_cache_requests_total", result="miss").inc()
+                return None
+        return await self.get_by_hash(content_hash)
+
+    async def get_by_hash(self, content_hash: str) -> Optional[CachedMedia]:
+        """
+        Gets the cached media with the given content hash.
+
+        Args:
+            content_hash (str): The content hash of the media.
+
+        Returns:
+            Optional[CachedMedia]: The cached media, or None if it is not cached or has expired.
+        """
+        with self._lock:
+            media, cached_at = self._media.get(content_hash, (None, 0))
+            if media is not None and self._is_expired(cached_at):
+                self._remove_from_memory(content_hash)
+                media = None
+            if media is not None:
+                self._media.move_to_end(content_hash)
+                metrics.counter("media_cache_requests_total", result="memory").inc()
+                return media
+
+        entry = await to_thread(self._read_payload, content_hash)
+        if entry is None:
+            metrics.counter("media_cache_requests_total", result="miss").inc()
+            return None
+        media, cached_at = entry
+        with self._lock:
+            self._add_to_memory(content_hash, media, cached_at)
+        metrics.counter("media_cache_requests_total", result="disk").inc()
+        return media
+
+    async def put(
+        self, source: Optional[str], content_hash: str, media: CachedMedia
+    ) -> None:
+        """
+        Caches media, optionally remembering which source it came from.
+
+        Args:
+            source (Optional[str]): The source of the media, or None if it has no stable source.
+            content_hash (str): The content hash of the media.
+            media (CachedMedia): The media to cache.
+        """
+        cached_at = time()
+        with self._lock:
+            self._add_to_memory(content_hash, media, cached_at)
+            if source is not None:
+                self._sources[source] = (content_hash, cached_at)
+                self._sources.move_to_end(source)
+                while len(self._sources) > MAX_MEMORY_SOURCES:
+                    self._sources.popitem(last=False)
+        try:
+            await to_thread(self._write, source, content_hash, media)
+        except OSError:
+            # The memory cache still works without the disk cache, so this is not fatal
+            system_logger.error("Failed to write to the media cache", exc_info=True)
+
+    def _add_to_memory(
+        self, content_hash: str, media: CachedMedia, cached_at: float
+    ) -> None:
+        if media.size > self.max_memory_size:
+            return
+        self._remove_from_memory(content_hash)
+        self._media[content_hash] = (media, cached_at)
+        self._memory_size += media.size
+        while self._memory_size > self.max_memory_size:
+            self._remove_from_memory(next(iter(self._media)))
+
+    def _remove_from_memory(self, content_hash: str) -> None:
+        media, _ = self._media.pop(content_hash, (None, 0))
+        if media is not None:
+            self._memory_size -= media.size
+
+    def _read_source(self, source: str) -> Optional[str]:
+        path = self._source_dir / self._source_file_name(source)
+        try:
+            cached_at = path.stat().st_mtime
+            if self._is_expired(cached_at):
+                path.unlink(missing_ok=True)
+                return None
+            content_hash = path.read_text()
+        except OSError:
+            return None
+        with self._lock:
+            self._sources[source] = (content_hash, cached_at)
+        return content_hash
+
+    def _read_payload(self, content_hash: str) -> Optional[tuple[CachedMedia, float]]:
+        path = self._payload_dir / f"{content_hash}.json"
+        try:
+            cached_at = path.stat().st_mtime
+            if self._is_expired(cached_at):
+                path.unlink(missing_ok=True)
+                return None
+            media = CachedMedia(**loads(path.read_text()))
+        except (OSError, ValueError, TypeError):
+            return None
+        return media, cached_at
+
+    def _write(
+        self, source: Optional[str], content_hash: str, media: CachedMedia
+    ) -> None:
+        payload = dumps(media._asdict()).encode()
+        with self._disk_lock:
+            self._payload_dir.mkdir(parents=True, exist_ok=True)
+            self._source_dir.mkdir(parents=True, exist_ok=True)
+            payload_path = self._payload_dir / f"{content_hash}.json"
+            replaced_size = 0
+            with suppress(FileNotFoundError):
+                replaced_size = payload_path.stat().st_size
+            # Write to a temporary file first, so a reader never sees a partially written payload
+            temporary_path = payload_path.with_suffix(".tmp")
+            temporary_path.write_bytes(payload)
+            temporary_path.replace(payload_path)
+            if source is not None:
+                (self._source_dir / self._source_file_name(source)).write_text(
+                    content_hash
+                )
+            self._disk_size += len(payload) - replaced_size
+            if (
+                self._disk_size > self.max_disk_size
+                or time() - self._last_eviction > EVICTION_INTERVAL
+            ):
+                self._evict_from_disk()
+
+    def _evict_from_disk(self) -> None:
+        # Evict expired entries first, then the oldest entries until the payloads fit within the size limit.
+        # Readers delete expired entries without the disk lock, so files that vanish during the scan are skipped
+        for directory in (self._source_dir, self._payload_dir):
+            for path in directory.iterdir():
+                with suppress(FileNotFoundError):
+                    if self._is_expired(path.stat().st_mtime):
+                        path.unlink(missing_ok=True)
+        payloads = []
+        for path in self._payload_dir.glob("*.json"):
+            with suppress(FileNotFoundError):
+                payloads.append((path, path.stat()))
+        payloads.sort(key=lambda payload: payload[1].st_mtime)
+        disk_size = sum(stat.st_size for _, stat in payloads)
+        for path, stat in payloads:
+            if disk_size <= self.max_disk_size:
+                break
+            disk_size -= stat.st_size
+            path.unlink(missing_ok=True)
+        # Recounted from the files, which corrects for entries deleted by readers since the last scan
+        self._disk_size = disk_size
+        self._last_eviction = time()
+
+
+media_cache = MediaCache()
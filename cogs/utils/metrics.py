@@ -0,0 +1,315 @@
+"""
+The in-process metrics registry used to record latencies across the bot.
+
+The registry is shared between the bot and the API thread started from QuantumKat.py, so recording is thread-safe.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Iterator, Optional, Union
+
+# How many of the most recent observations each histogram keeps for calculating percentiles
+MAX_SAMPLES = 2048
+
+
+class Histogram:
+    """
+    Records observed values and summarizes them as count, sum, percentiles and max.
+
+    Count, sum and max cover every observation, while percentiles are calculated from the most recent MAX_SAMPLES
+    observations to keep memory bounded.
+
+    Methods:
+        observe(value): Records a value.
+        percentile(percent): Calculates a percentile of the recent observations.
+        summary(): Returns the count, sum, p50, p95, p99 and max of the observations.
+        time(): A context manager that observes how many seconds its body took.
+    """
+
+    def __init__(self, max_samples: int = MAX_SAMPLES) -> None:
+        self._samples: deque[float] = deque(maxlen=max_samples)
+        self._lock = Lock()
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        """
+        Records a value.
+
+        Args:
+            value (float): The value to record.
+        """
+        with self._lock:
+            self._samples.append(value)
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def percentile(self, percent: float) -> float:
+        """
+        Calculates a percentile of the recent observations, using the nearest-rank method.
+
+        Args:
+            percent (float): The percentile to calculate, between 0 and 100.
+
+        Returns:
+            float: The value at the given percentile, or 0 if nothing has been observed.
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        return self._nearest_rank(samples, percent)
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        """
+        A context manager that observes how many seconds its body took, including when it raises.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+    @staticmethod
+    def _nearest_rank(samples: list[float], percent: float) -> float:
+        if not samples:
+            return 0.0
+        rank = max(round(percent / 100 * len(samples)) - 1, 0)
+        return samples[min(rank, len(samples) - 1)]
+
+    def summary(self) -> dict[str, float]:
+        """
+        Returns the count, sum, p50, p95, p99 and max of the observations.
+
+        Returns:
+            dict[str, float]: The summary of the observations.
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+            count, total, maximum = self.count, self.sum, self.max
+        return {
+            "count": count,
+            "sum": total,
+            "p50": self._nearest_rank(samples, 50),
+            "p95": self._nearest_rank(samples, 95),
+            "p99": self._nearest_rank(samples, 99),
+            "max": maximum,
+        }
+
+
+class Counter:
+    """
+    A value that only ever increases, such as the number of invocations of a command.
+
+    Methods:
+        inc(amount): Increases the counter.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        """
+        Increases the counter.
+
+        Args:
+            amount (float): The amount to increase the counter by. Defaults to 1.
+        """
+        with self._lock:
+            self.value += amount
+
+
+class Gauge:
+    """
+    A value that can go up and down, such as the gateway latency.
+
+    The value is either set directly, or read from a function every time it is collected.
+
+    Methods:
+        set(value): Sets the value.
+        set_function(function): Reads the value from the given function from now on.
+    """
+
+    def __init__(self) -> None:
+        self._value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+
+    @property
+    def value(self) -> float:
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+
+Metric = Union[Histogram, Counter, Gauge]
+
+# The Prometheus type each kind of metric is exposed as.
+# Histograms are exposed as summaries, since they calculate the quantiles themselves
+PROMETHEUS_TYPES = {Histogram: "summary", Counter: "counter", Gauge: "gauge"}
+
+
+class MetricsRegistry:
+    """
+    A registry of named metrics, each of which can have multiple label sets.
+
+    Methods:
+        histogram(name, **labels): Gets or creates the histogram with the given name and labels.
+        counter(name, **labels): Gets or creates the counter with the given name and labels.
+        gauge(name, **labels): Gets or creates the gauge with the given name and labels.
+        get_histograms(name): Gets all histograms with the given name, keyed by their labels.
+        summarize(name, label): Summarizes all histograms with the given name, keyed by the value of one label.
+        render_prometheus(): Renders all metrics in the Prometheus text exposition format.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, dict[tuple, Metric]] = {}
+        self._types: dict[str, type] = {}
+        self._lock = Lock()
+
+    def _get_or_create(self, metric_type: type, name: str, labels: dict) -> Metric:
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        with self._lock:
+            registered_type = self._types.setdefault(name, metric_type)
+            if registered_type is not metric_type:
+                raise ValueError(
+                    f"Metric {name} is already registered as a {registered_type.__name__}."
+                )
+            family = self._metrics.setdefault(name, {})
+            if key not in family:
+                family[key] = metric_type()
+            return family[key]
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        """
+        Gets or creates the histogram with the given name and labels.
+
+        Args:
+            name (str): The name of the metric.
+            **labels (str): The labels identifying the histogram within the metric.
+
+        Returns:
+            Histogram: The histogram.
+        """
+        return self._get_or_create(Histogram, name, labels)
+
+    def counter(self, name: str, **labels: str) -> Counter:
+        """
+        Gets or creates the counter with the given name and labels.
+
+        Args:
+            name (str): The name of the metric.
+            **labels (str): The labels identifying the counter within the metric.
+
+        Returns:
+            Counter: The counter.
+        """
+        return self._get_or_create(Counter, name, labels)
+
+    def gauge(self, name: str, **labels: str) -> Gauge:
+        """
+        Gets or creates the gauge with the given name and labels.
+
+        Args:
+            name (str): The name of the metric.
+            **labels (str): The labels identifying the gauge within the metric.
+
+        Returns:
+            Gauge: The gauge.
+        """
+        return self._get_or_create(Gauge, name, labels)
+
+    def get_histograms(self, name: str) -> dict[tuple, Histogram]:
+        """
+        Gets all histograms with the given name.
+
+        Args:
+            name (str): The name of the metric.
+
+        Returns:
+            dict[tuple, Histogram]: The histograms, keyed by their labels as sorted (label, value) tuples.
+        """
+        with self._lock:
+            if self._types.get(name) is not Histogram:
+                return {}
+            return dict(self._metrics[name])
+
+    def summarize(self, name: str, label: str) -> dict[str, dict[str, float]]:
+        """
+        Summarizes all histograms with the given name, sorted by the total of their observations in descending order.
+
+        Args:
+            name (str): The name of the metric.
+            label (str): The label whose value is used as the key for each summary.
+
+        Returns:
+            dict[str, dict[str, float]]: The summaries, keyed by the value of the label.
+        """
+        summaries = {
+            dict(labels).get(label, ""): histogram.summary()
+            for labels, histogram in self.get_histograms(name).items()
+        }
+        return dict(
+            sorted(summaries.items(), key=lambda item: item[1]["sum"], reverse=True)
+        )
+
+    @staticmethod
+    def _format_labels(labels: tuple) -> str:
+        if not labels:
+            return ""
+        escaped = (
+            (
+                label,
+                value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+            )
+            for label, value in labels
+        )
+        return "{" + ",".join(f'{label}="{value}"' for label, value in escaped) + "}"
+
+    def render_prometheus(self) -> str:
+        """
+        Renders all metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The rendered metrics.
+        """
+        with self._lock:
+            families = {name: dict(family) for name, family in self._metrics.items()}
+            types = dict(self._types)
+
+        lines = []
+        for name, family in sorted(families.items()):
+            lines.append(f"# TYPE {name} {PROMETHEUS_TYPES[types[name]]}")
+            for labels, metric in family.items():
+                if isinstance(metric, Histogram):
+                    summary = metric.summary()
+                    for quantile, key in (
+                        ("0.5", "p50"),
+                        ("0.95", "p95"),
+                        ("0.99", "p99"),
+                    ):
+                        quantile_labels = self._format_labels(
+                            labels + (("quantile", quantile),)
+                        )
+                        lines.append(f"{name}{quantile_labels} {summary[key]}")
+                    lines.append(
+                        f"{name}_sum{self._format_labels(labels)} {summary['sum']}"
+                    )
+                    lines.append(
+                        f"{name}_count{self._format_labels(labels)} {summary['count']}"
+                    )
+                else:
+                    lines.append(f"{name}{self._format_labels(labels)} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,98 @@
+"""
+Prompt templates for the chat commands, which render a prompt and count its tokens without re-tokenizing the static text.
+
+The template is normalized and split into segments once: runs of static lines, whose tokens are counted once
+and cached, and lines with placeholders, which are the only text tokenized when a prompt is rendered.
+Every segment but the last ends with the line break after it, and every line starts and ends with
+non-whitespace, so no token can span two segments and the sum of the segment counts is exactly the token count
+of the whole prompt.
+"""
+
+from string import Formatter
+from textwrap import dedent
+from typing import Any, Optional
+
+from tiktoken import Encoding
+
+from cogs.utils.utils import encoding as default_encoding
+
+
+class _Segment:
+    def __init__(self, text: str, fields: frozenset[str], encoding: Encoding) -> None:
+        self.text = text
+        self.fields = fields
+        self._encoding = encoding
+        if not fields:
+            # The token count with and without the line break, as the segment may end up being the last one
+            self._tokens = (
+                len(encoding.encode(text)),
+                len(encoding.encode(text + "\n")),
+            )
+
+    def is_included(self, values: dict[str, Any]) -> bool:
+        return all(values.get(field) is not None for field in self.fields)
+
+    def render(self, values: dict[str, Any], last: bool) -> tuple[str, int]:
+        if not self.fields:
+            return (self.text if last else self.text + "\n"), self._tokens[not last]
+        # The values are substituted as-is, so braces in them are never parsed as placeholders
+        text = self.text.format(**values).strip()
+        if not last:
+            text += "\n"
+        return text, len(self._encoding.encode(text))
+
+
+class PromptTemplate:
+    """
+    A prompt with {placeholders}, which is rendered together with its exact token count.
+
+    Indentation and repeated whitespace are removed from the template, so they aren't sent, and paid for, on every request.
+    A line is left out of the prompt if any of its placeholders is given None, e.g. for context that isn't always present.
+
+    Methods:
+        render(**values): Renders the prompt and counts its tokens.
+    """
+
+    def __init__(self, template: str, encoding: Encoding = default_encoding) -> None:
+        lines = [" ".join(line.split()) for line in dedent(template).splitlines()]
+        self._segments: list[_Segment] = []
+        static_lines: list[str] = []
+        for line in filter(None, lines):
+            fields = frozenset(
+                field for _, field, _, _ in Formatter().parse(line) if field
+            )
+            if not fields:
+                # Unescape doubled braces, since static lines are never formatted
+                static_lines.append(line.format())
+                continue
+            if static_lines:
+                self._segments.append(
+                    _Segment("\n".join(static_lines), frozenset(), encoding)
+                )
+                static_lines = []
+            self._segments.append(_Segment(line, fields, encoding))
+        if static_lines:
+            self._segments.append(
+                _Segment("\n".join(static_lines), frozenset(), encoding)
+            )
+
+    def render(self, **values: Optional[Any]) -> tuple[str, int]:
+        """
+        Renders the prompt and counts its tokens, only tokenizing the lines with placeholders.
+
+        Args:
+            **values: The values of the placeholders. Lines with a placeholder that is None or missing are left out.
+
+        Returns:
+            tuple[str, int]: The rendered prompt, and the number of tokens in it.
+        """
+        segments = [
+            segment for segment in self._segments if segment.is_included(values)
+        ]
+        rendered = [
+            segment.render(values, index == len(segments) - 1)
+            for index, segment in enumerate(segments)
+        ]
+        return "".join(text for text, _ in rendered), sum(
+            tokens for _, tokens in rendered
+        )
@@ -0,0 +1,84 @@
+"""
+Shows a chat response in Discord while it is still being generated.
+
+The first text is replied as soon as it arrives, and the reply is then edited with the text generated since,
+at most once every EDIT_INTERVAL seconds to stay within Discord's rate limit for message edits.
+When the reply would grow past Discord's message length limit, it is split at the last sentence boundary
+and the response continues in a new reply.
+"""
+
+from time import monotonic
+from typing import Optional
+
+from discord import Message
+from discord.ext import commands
+
+from cogs.utils.utils import MESSAGE_LIMIT, split_at_sentence_boundary
+
+# The minimum number of seconds between two edits of a reply. Discord allows 5 edits per 5 seconds in a channel
+EDIT_INTERVAL = 1.0
+
+
+class StreamingReply:
+    """
+    A reply that is progressively edited as more of a streamed response arrives.
+
+    Attributes:
+        text (str): The whole response received so far.
+
+    Methods:
+        feed(delta): Adds newly generated text to the reply.
+        finish(): Shows any text not shown yet, and returns the whole response.
+    """
+
+    def __init__(
+        self, ctx: commands.Context, edit_interval: float = EDIT_INTERVAL
+    ) -> None:
+        self.ctx = ctx
+        self.edit_interval = edit_interval
+        self.text = ""
+        # The text of the current reply, what it currently shows, and when it was last sent or edited
+        self._pending = ""
+        self._shown = ""
+        self._message: Optional[Message] = None
+        self._last_update = 0.0
+
+    async def feed(self, delta: str) -> None:
+        """
+        Adds newly generated text to the reply, and shows it unless the reply was edited too recently.
+
+        Args:
+            delta (str): The newly generated text.
+        """
+        self.text += delta
+        self._pending += delta
+        while len(self._pending) > MESSAGE_LIMIT:
+            # The current reply is full, so it is completed up to the last sentence and the rest starts a new one
+            part, self._pending = split_at_sentence_boundary(self._pending)
+            await self._show(part, force=True)
+            self._message = None
+            self._shown = ""
+        await self._show(self._pending)
+
+    async def finish(self) -> str:
+        """
+        Shows any text not shown yet.
+
+        Returns:
+            str: The whole response.
+        """
+        await self._show(self._pending, force=True)
+        return self.text
+
+    async def _show(self, content: str, force: bool = False) -> None:
+        # Discord rejects empty messages, so nothing is sent until there is visible text
+        if not content.strip() or content == self._shown:
+            return
+        if self._message is None:
+            self._message = await self.ctx.reply(content, silent=True)
+        elif force or monotonic() - self._last_update >= self.edit_interval:
+            await self._message.edit(content=content)
+        else:
+            return
+        self._shown = content
+        self._last_update = monotonic()
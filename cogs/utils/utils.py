@@ -1,23 +1,26 @@
 from re import findall
 from datetime import datetime
 from calendar import monthrange
-from requests import get, head
-from requests.exceptions import RequestException
+from asyncio import TimeoutError
+from aiohttp import ClientError, StreamReader
 from discord.ext import commands
 from tiktoken import encoding_for_model
 from mimetypes import guess_extension
-from magic import Magic
-from PIL import Image
+from PIL import Image, ImageChops, ImageOps, ImageSequence, ImageStat
 from io import BytesIO
 from base64 import b64encode
 from pathlib import Path
 from subprocess import check_output, STDOUT
 from shutil import which
-from discord import Guild, User
-from os import path, listdir
-from typing import Tuple
+from discord import Attachment, Guild, User
+from os import environ, path, listdir
+from typing import Mapping, Optional, Tuple
 
 from cogs.utils._logger import system_logger
+from cogs.utils.http_client import http_client
+from cogs.utils.media_cache import CachedMedia, media_cache
+from cogs.utils.image_pipeline import image_pipeline
+from cogs.utils.file_type import detect_mime_type
 
 SUPPORTED_IMAGE_FORMATS = [
     ".png",
@@ -34,34 +37,92 @@ EXTRACT_MEDIA_TYPES = ["text", "application"]
 
 OPENAI_IMAGE_SIZE_LIMIT_MB = 20
 
+# The maximum length of a Discord message, and where messages longer than it are preferably split
+MESSAGE_LIMIT = 2000
+SENTENCE_BOUNDARIES = (". ", "! ", "? ", "\n")
+
+# How many bytes are read from the start of a download to determine its file type
+SNIFF_SIZE = 2048
+
+# How frames are chosen from animated GIFs: "uniform" spreads them evenly over the animation,
+# "scene" picks the frames that differ the most from the frame before them
+GIF_FRAME_SELECTION = environ.get("GIF_FRAME_SELECTION", "uniform")
+if GIF_FRAME_SELECTION not in ("uniform", "scene"):
+    raise ValueError(
+        f"Invalid GIF_FRAME_SELECTION {GIF_FRAME_SELECTION}. Choose from uniform, scene."
+    )
+
+# How many frames of an animated GIF are sent to the model, the maximum width and height they are resized to,
+# and the format and quality they are encoded with
+GIF_MAX_FRAMES = int(environ.get("GIF_MAX_FRAMES") or 8)
+GIF_FRAME_MAX_SIZE = int(environ.get("GIF_FRAME_MAX_SIZE") or 512)
+GIF_FRAME_FORMAT = environ.get("GIF_FRAME_FORMAT", "JPEG").upper()
+if GIF_FRAME_FORMAT not in ("JPEG", "WEBP"):
+    raise ValueError(
+        f"Invalid GIF_FRAME_FORMAT {GIF_FRAME_FORMAT}. Choose from JPEG, WEBP."
+    )
+GIF_FRAME_QUALITY = 80
+
+# The largest resolution the model works at. Larger images are shrunk to fit,
+# so that the longest side is at most IMAGE_MAX_LONG_SIDE and the shortest at most IMAGE_MAX_SHORT_SIDE pixels
+IMAGE_MAX_LONG_SIDE = 2048
+IMAGE_MAX_SHORT_SIDE = 768
+
+# The quality images are re-encoded with, and the size in bytes under which images that fit are sent unchanged
+IMAGE_QUALITY = int(environ.get("IMAGE_QUALITY") or 85)
+IMAGE_PASSTHROUGH_SIZE = 512 * 1024
+
+# The size of the grayscale thumbnails compared to find scene changes
+SCENE_THUMBNAIL_SIZE = (32, 32)
+
+# Downloads are read in chunks that start at MIN_CHUNK_SIZE bytes,
+# and double every time the stream fills a whole chunk, up to MAX_CHUNK_SIZE bytes
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 1024**2
+
 
 class FileInfoFromURL:
-    def __init__(self, url: str):
+    def __init__(self, url: str, header: Mapping[str, str]):
         """
         Initialize a new instance of the class.
 
+        Use `FileInfoFromURL.from_url` to create an instance from the headers of a URL.
+
         Args:
             url (str): The URL of the file.
+            header (Mapping[str, str]): The response headers of the URL.
+
+        """
+        self.url = url
+        self.header = header
+
+    @classmethod
+    async def from_url(cls, url: str) -> "FileInfoFromURL":
+        """
+        Retrieves the headers of the file at the given URL.
+
+        Args:
+            url (str): The URL of the file.
+
+        Returns:
+            FileInfoFromURL: The file info of the URL.
 
         Raises:
             ValueError: If the URL cannot be accessed.
-
         """
-        self.url = url
         try:
-            header = head(url)
-            header.raise_for_status()
-        except RequestException:
+            async with http_client.head(url, allow_redirects=True) as response:
+                return cls(url, response.headers)
+        except (ClientError, TimeoutError):
             try:
-                # If the header request fails, try using a streamed GET request to get the header
-                header = get(url, stream=True)
-                header.raise_for_status()
-                header.close()
+                # If the header request fails, try using a GET request to get the header, without reading the body
+                async with http_client.get(url) as response:
+                    return cls(url, response.headers)
             except (
-                RequestException
+                ClientError,
+                TimeoutError,
             ) as e:  # If this fails too, assume the file cannot be accessed
                 raise ValueError(f"Could not access the file at {url}.") from e
-        self.header = header.headers
 
     @property
     def header_file_size(self) -> int:
@@ -93,17 +154,6 @@ class FileInfoFromURL:
         except KeyError:
             return None
 
-    @property
-    def get_header_mime_type(self) -> str:
-        """
-        Attempts to download the first 1 KB of the file and determine the MIME type.
-
-        Returns:
-            str: The MIME type of the header.
-        """
-        file = download_file(self.url, amount_or_limit=1, unit="KB")
-        return guess_file_extension(file)
-
 
 class FileSizeLimitError(Exception):
     """
@@ -129,7 +179,7 @@ class UnsupportedImageFormatError(Exception):
 encoding = encoding_for_model("gpt-4o")
 
 
-def guess_download_type(url: str) -> str:
+async def guess_download_type(url: str) -> str:
     """
     Guesses the download type based on the Content-Type header from the URL.
 
@@ -143,7 +193,7 @@ def guess_download_type(url: str) -> str:
             - "unknown" if the download type cannot be determined.
 
     """
-    file_info = FileInfoFromURL(url)
+    file_info = await FileInfoFromURL.from_url(url)
     type, subtype = tuple(file_info.header_mime_type.split("/"))
     if type in DIRECT_MEDIA_TYPES:
         return "direct"
@@ -176,7 +226,60 @@ def get_field_from_1password(reference: str) -> str:
     return token
 
 
-def download_file(
+async def read_bounded(
+    stream: StreamReader,
+    limit: Optional[int] = None,
+    size_hint: Optional[int] = None,
+    initial: bytes = b"",
+) -> tuple[bytes, bool]:
+    """
+    Reads a stream into a single buffer, stopping once the limit is reached.
+
+    The buffer is preallocated from the size hint, so the data is copied once instead of every time a chunk arrives.
+
+    Args:
+        stream (aiohttp.StreamReader): The stream to read from.
+        limit (int, optional): The maximum amount of bytes to read, including the initial data. Defaults to no limit.
+        size_hint (int, optional): The expected size of the whole stream, e.g. from the Content-Length header.
+        initial (bytes, optional): Data already read from the start of the stream. Defaults to nothing.
+
+    Returns:
+        tuple[bytes, bool]: The data read, and whether the stream has more data than the limit.
+    """
+    # Read one byte past the limit, so a stream of exactly the limit isn't mistaken for a larger one
+    max_size = limit + 1 if limit is not None else None
+    capacity = max(size_hint or 0, len(initial), MIN_CHUNK_SIZE)
+    if max_size is not None:
+        capacity = min(capacity, max_size)
+    buffer = bytearray(capacity)
+    buffer[: len(initial)] = initial
+    size = len(initial)
+    chunk_size = MIN_CHUNK_SIZE
+
+    while max_size is None or size < max_size:
+        to_read = chunk_size if max_size is None else min(chunk_size, max_size - size)
+        chunk = await stream.read(to_read)
+        if not chunk:
+            break
+        end = size + len(chunk)
+        if end > len(buffer):
+            # The size hint was wrong or missing, so grow the buffer geometrically
+            grow_to = max(end, len(buffer) * 2)
+            if max_size is not None:
+                grow_to = min(grow_to, max_size)
+            buffer.extend(bytes(grow_to - len(buffer)))
+        buffer[size:end] = chunk
+        size = end
+        if len(chunk) == to_read:
+            chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+
+    # Slicing a memoryview instead of the buffer itself copies the data once instead of twice
+    if limit is not None and size > limit:
+        return bytes(memoryview(buffer)[:limit]), True
+    return bytes(memoryview(buffer)[:size]), False
+
+
+async def download_file(
     url: str,
     amount_or_limit: int = None,
     unit: str = None,
@@ -192,7 +295,7 @@ def download_file(
         raise_exception (bool, optional): Whether to raise an exception if the downloaded file exceeds the specified limit. Defaults to False.
 
     Returns:
-        bytes: The downloaded file.
+        bytes: The downloaded file. If it exceeds the limit and raise_exception is False, only the data up to the limit.
 
     Raises:
         ValueError: If the unit is invalid or if the unit is provided without specifying the amount.
@@ -213,24 +316,71 @@ def download_file(
         amount_or_limit = amount_or_limit * UNITS[unit]
 
     try:
-        with get(url, stream=True) as response:
-            response.raise_for_status()
-            if amount_or_limit:
-                data = b""
-                for chunk in response.iter_content(chunk_size=1024):
-                    data += chunk
-                    if len(data) >= amount_or_limit:
-                        if raise_exception:
-                            raise FileSizeLimitError(
-                                f"The image from {url} exceeds the specified limit of {original_amount_or_limit} {unit}."
-                            )
-            else:
-                data = response.content
-    except RequestException as e:
+        async with http_client.get(url) as response:
+            data, exceeds_limit = await read_bounded(
+                response.content, amount_or_limit, response.content_length
+            )
+            if exceeds_limit and raise_exception:
+                raise FileSizeLimitError(
+                    f"The image from {url} exceeds the specified limit of {original_amount_or_limit} {unit}."
+                )
+    except (ClientError, TimeoutError) as e:
         raise ValueError(f"Could not access the file at {url}.") from e
     return data
 
 
+async def download_image(url: str) -> tuple[bytes, str]:
+    """
+    Downloads a supported image from the specified URL in a single request.
+
+    The file type is determined from the first bytes of the download, and the size limit is enforced as the rest
+    arrives, so unsupported or oversized files are rejected without downloading them in full.
+
+    Args:
+        url (str): The URL of the image to download.
+
+    Returns:
+        tuple[bytes, str]: The downloaded image, and its file extension.
+
+    Raises:
+        UnsupportedImageFormatError: If the file is not a supported image format.
+        FileSizeLimitError: If the image exceeds the size limit.
+        ValueError: If the file at the specified URL cannot be accessed.
+    """
+    limit = OPENAI_IMAGE_SIZE_LIMIT_MB * UNITS["MB"]
+    size_limit_error = FileSizeLimitError(
+        f"The image from the URL {url} exceeds the size limit of {OPENAI_IMAGE_SIZE_LIMIT_MB} MB."
+    )
+    try:
+        async with http_client.get(url) as response:
+            if response.content_length and response.content_length > limit:
+                raise size_limit_error
+
+            # Read until there is enough data to determine the file type, or the file ends
+            head = b""
+            while len(head) < SNIFF_SIZE:
+                chunk = await response.content.read(SNIFF_SIZE - len(head))
+                if not chunk:
+                    break
+                head += chunk
+            stream_is_supported, file_type = stream_is_supported_image(
+                head, return_file_type=True
+            )
+            if not stream_is_supported:
+                raise UnsupportedImageFormatError(
+                    f"The image from the URL {url} has {file_type} format, but only {', '.join(SUPPORTED_IMAGE_FORMATS)} is supported."
+                )
+
+            data, exceeds_limit = await read_bounded(
+                response.content, limit, response.content_length, initial=head
+            )
+            if exceeds_limit:
+                raise size_limit_error
+    except (ClientError, TimeoutError) as e:
+        raise ValueError(f"Could not access the file at {url}.") from e
+    return data, file_type
+
+
 def strip_embed_disabler(url: str) -> str:
     """
     Strips the greater-than and less-than symbols from a given URL.
@@ -244,12 +394,17 @@ def strip_embed_disabler(url: str) -> str:
     return url.replace("<", "").replace(">", "")
 
 
-def get_image_as_base64(url_or_byte_stream: str | bytes) -> list[str]:
+async def get_image_as_base64(
+    url_or_byte_stream_or_attachment: str | bytes | Attachment,
+) -> list[str]:
     """
-    Converts an image from a URL or byte stream into a base64 encoded string.
+    Converts an image from a URL, byte stream or Discord attachment into a base64 encoded string.
+
+    Encoded images are cached by their URL or attachment ID, and by the hash of their content,
+    so an image that has been seen before is neither downloaded nor encoded again.
 
     Args:
-        url_or_byte_stream (str | bytes): The URL or byte stream of the image.
+        url_or_byte_stream_or_attachment (str | bytes | discord.Attachment): The URL, byte stream or attachment of the image.
 
     Returns:
         list[str]: A list containing the base64 encoded string of the image.
@@ -257,73 +412,162 @@ def get_image_as_base64(url_or_byte_stream: str | bytes) -> list[str]:
     Raises:
         UnsupportedImageFormatError: If the image format is not supported.
         FileSizeError: If the image size exceeds the limit.
+        ValueError: If the image at the URL cannot be accessed.
+        ImagePipelineError: If the image could not be encoded.
 
     """
-    byte_stream = None
-
-    if isinstance(url_or_byte_stream, bytes):
-        stream_is_supported, file_type = stream_is_supported_image(
-            url_or_byte_stream, return_file_type=True
+    source = None
+    if isinstance(url_or_byte_stream_or_attachment, str):
+        source = f"url:{url_or_byte_stream_or_attachment}"
+    if isinstance(url_or_byte_stream_or_attachment, Attachment):
+        source = f"attachment:{url_or_byte_stream_or_attachment.id}"
+    if source is not None:
+        cached_media = await media_cache.get(source)
+        if cached_media is not None:
+            return cached_media.payload
+
+    if isinstance(url_or_byte_stream_or_attachment, str):
+        byte_stream, file_type = await download_image(url_or_byte_stream_or_attachment)
+        content_hash = await media_cache.hash_content(byte_stream)
+        cached_media = await media_cache.get_by_hash(content_hash)
+    else:
+        if isinstance(url_or_byte_stream_or_attachment, Attachment):
+            # Check the size Discord reports before downloading the attachment
+            if content_size_is_over_limit(
+                url_or_byte_stream_or_attachment.size, OPENAI_IMAGE_SIZE_LIMIT_MB, "MB"
+            ):
+                raise FileSizeLimitError(
+                    f"The image exceeds the size limit of {OPENAI_IMAGE_SIZE_LIMIT_MB} MB."
+                )
+            byte_stream = await url_or_byte_stream_or_attachment.read()
+        else:
+            byte_stream = url_or_byte_stream_or_attachment
+
+        # Only validated images are cached, so a cached image can skip the validation as well
+        content_hash = await media_cache.hash_content(byte_stream)
+        cached_media = await media_cache.get_by_hash(content_hash)
+        if cached_media is None:
+            # Validated here rather than in the image pipeline, so the file type detections are counted
+            # by the bot process
+            file_type = validate_image(byte_stream)
+
+    if cached_media is None:
+        cached_media = CachedMedia(
+            file_type=file_type,
+            payload=await image_pipeline.run(encode_byte_stream_to_base64, byte_stream),
         )
-        if not stream_is_supported:
-            raise UnsupportedImageFormatError(
-                f"File type {file_type} is not supported. Supported image formats are {', '.join(SUPPORTED_IMAGE_FORMATS)}."
-            )
-        if content_size_is_over_limit(
-            url_or_byte_stream, OPENAI_IMAGE_SIZE_LIMIT_MB, "MB"
-        ):
-            raise FileSizeLimitError(
-                f"The image exceeds the size limit of {OPENAI_IMAGE_SIZE_LIMIT_MB} MB."
-            )
-        byte_stream = url_or_byte_stream
+    await media_cache.put(source, content_hash, cached_media)
+    return cached_media.payload
+
+
+def validate_image(byte_stream: bytes) -> str:
+    """
+    Validates that a byte stream is a supported image within the size limit.
 
-    if isinstance(url_or_byte_stream, str):
-        file_info = FileInfoFromURL(url_or_byte_stream)
-        file_size = file_info.header_file_size
-        file_type = get_mime_type(
-            file_info.header_mime_type or file_info.get_header_mime_type
+    Args:
+        byte_stream (bytes): The image to validate.
+
+    Returns:
+        str: The file extension of the image.
+
+    Raises:
+        UnsupportedImageFormatError: If the image format is not supported.
+        FileSizeError: If the image size exceeds the limit.
+    """
+    stream_is_supported, file_type = stream_is_supported_image(
+        byte_stream, return_file_type=True
+    )
+    if not stream_is_supported:
+        raise UnsupportedImageFormatError(
+            f"File type {file_type} is not supported. Supported image formats are {', '.join(SUPPORTED_IMAGE_FORMATS)}."
         )
-        if file_type not in SUPPORTED_IMAGE_FORMATS:
-            raise UnsupportedImageFormatError(
-                f"The image from the URL {url_or_byte_stream} has {file_type} format, but only {', '.join(SUPPORTED_IMAGE_FORMATS)} is supported."
-            )
-        if content_size_is_over_limit(file_size, OPENAI_IMAGE_SIZE_LIMIT_MB, "MB"):
-            raise FileSizeLimitError(
-                f"The image from the URL {url_or_byte_stream} exceeds the size limit of {OPENAI_IMAGE_SIZE_LIMIT_MB} MB."
-            )
-        byte_stream = download_file(
-            url_or_byte_stream, amount_or_limit=20, unit="MB", raise_exception=True
+    if content_size_is_over_limit(byte_stream, OPENAI_IMAGE_SIZE_LIMIT_MB, "MB"):
+        raise FileSizeLimitError(
+            f"The image exceeds the size limit of {OPENAI_IMAGE_SIZE_LIMIT_MB} MB."
         )
-
-    return encode_byte_stream_to_base64(byte_stream)
+    return file_type
 
 
 def get_base64_encoded_frames_from_gif(byte_stream: bytes) -> list:
     """
-    Retrieves the frames from a GIF image and returns them as a list of base64 encoded strings.
+    Retrieves representative frames from a GIF image and returns them as a list of base64 encoded strings.
+
+    At most GIF_MAX_FRAMES frames are selected using GIF_FRAME_SELECTION,
+    resized to fit within GIF_FRAME_MAX_SIZE and encoded as GIF_FRAME_FORMAT.
 
     Parameters:
     - byte_stream (bytes): The GIF image to retrieve frames from.
 
     Returns:
-    - list: A list of base64 encoded strings representing the frames of the GIF image.
+    - list: A list of base64 encoded strings representing the selected frames of the GIF image.
     """
     img = Image.open(BytesIO(byte_stream))
+    frame_count = getattr(img, "n_frames", 1)
+    if GIF_FRAME_SELECTION == "scene":
+        selected_frames = select_scene_change_frames(img, GIF_MAX_FRAMES)
+    else:
+        selected_frames = select_uniform_frames(frame_count, GIF_MAX_FRAMES)
+
     base64_frames = []
-    try:
-        while True:
-            buffer = BytesIO()
-            img.save(buffer, format="jpg")  # convert image to bytes
-            img_bytes = buffer.getvalue()
-            img_b64 = b64encode(img_bytes).decode()  # convert bytes to base64 string
-            base64_frames.append(img_b64)
-            img.seek(img.tell() + 1)  # move to next frame
-    except EOFError:
-        pass  # end of sequence
+    for index, frame in enumerate(ImageSequence.Iterator(img)):
+        if index not in selected_frames:
+            continue
+        frame = frame.convert("RGB")
+        frame.thumbnail((GIF_FRAME_MAX_SIZE, GIF_FRAME_MAX_SIZE), Image.LANCZOS)
+        buffer = BytesIO()
+        frame.save(buffer, format=GIF_FRAME_FORMAT, quality=GIF_FRAME_QUALITY)
+        base64_frames.append(b64encode(buffer.getvalue()).decode())
+        if len(base64_frames) == len(selected_frames):
+            break
 
     return base64_frames
 
 
+def select_uniform_frames(frame_count: int, max_frames: int) -> set[int]:
+    """
+    Selects frames spread evenly over an animation, always including the first and last frame.
+
+    Parameters:
+    - frame_count (int): The number of frames in the animation.
+    - max_frames (int): The maximum number of frames to select.
+
+    Returns:
+    - set[int]: The indexes of the selected frames.
+    """
+    if frame_count <= max_frames:
+        return set(range(frame_count))
+    if max_frames == 1:
+        return {0}
+    step = (frame_count - 1) / (max_frames - 1)
+    return {round(i * step) for i in range(max_frames)}
+
+
+def select_scene_change_frames(img: Image.Image, max_frames: int) -> set[int]:
+    """
+    Selects the first frame of an animation, and the frames that differ the most from the frame before them.
+
+    Frames are compared as small grayscale thumbnails, so this is cheap compared to encoding the frames.
+
+    Parameters:
+    - img (PIL.Image.Image): The animation to select frames from.
+    - max_frames (int): The maximum number of frames to select.
+
+    Returns:
+    - set[int]: The indexes of the selected frames.
+    """
+    differences = []
+    previous = None
+    for index, frame in enumerate(ImageSequence.Iterator(img)):
+        thumbnail = frame.convert("L").resize(SCENE_THUMBNAIL_SIZE)
+        if previous is not None:
+            difference = ImageStat.Stat(ImageChops.difference(thumbnail, previous))
+            differences.append((difference.mean[0], index))
+        previous = thumbnail
+    img.seek(0)
+    scene_changes = sorted(differences, reverse=True)[: max_frames - 1]
+    return {0, *(index for _, index in scene_changes)}
+
+
 def get_file_size(file_path: str) -> int:
     """
     Retrieves the size of a file.
@@ -342,6 +586,7 @@ def encode_byte_stream_to_base64(byte_stream: bytes) -> list[str]:
     Encodes a byte stream to base64 format.
 
     If the byte stream is an animated GIF, the function retrieves the frames from the GIF and encodes them into a list of base64 formatted strings.
+    Otherwise the image is shrunk to the resolution the model works at before it is encoded.
 
     Args:
         byte_stream (bytes): The byte stream to be encoded.
@@ -352,7 +597,49 @@ def encode_byte_stream_to_base64(byte_stream: bytes) -> list[str]:
     """
     if is_animated_gif(byte_stream):
         return get_base64_encoded_frames_from_gif(byte_stream)
-    return [b64encode(byte_stream).decode()]
+    return [b64encode(preprocess_image(byte_stream)).decode()]
+
+
+def preprocess_image(byte_stream: bytes) -> bytes:
+    """
+    Resizes an image to fit the resolution the model works at, and re-encodes it with IMAGE_QUALITY.
+
+    The model downsamples larger images itself, so sending them at full size only adds upload time and latency.
+    Small images that already fit are returned unchanged, to avoid losing quality for nothing.
+
+    Args:
+        byte_stream (bytes): The image to preprocess.
+
+    Returns:
+        bytes: The preprocessed image, or the original image if it is smaller.
+    """
+    img = Image.open(BytesIO(byte_stream))
+    width, height = img.size
+    scale = min(
+        1,
+        IMAGE_MAX_LONG_SIDE / max(width, height),
+        IMAGE_MAX_SHORT_SIDE / min(width, height),
+    )
+    if scale == 1 and len(byte_stream) <= IMAGE_PASSTHROUGH_SIZE:
+        return byte_stream
+
+    # Re-encoding drops the EXIF orientation, so apply it to the pixels first. Otherwise phone photos end up sideways
+    img = ImageOps.exif_transpose(img)
+    if scale < 1:
+        width, height = img.size
+        img = img.resize(
+            (max(round(width * scale), 1), max(round(height * scale), 1)),
+            Image.LANCZOS,
+        )
+
+    buffer = BytesIO()
+    # JPEG can't store transparency, so transparent images are encoded as WebP instead
+    if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+        img.convert("RGBA").save(buffer, format="WEBP", quality=IMAGE_QUALITY)
+    else:
+        img.convert("RGB").save(buffer, format="JPEG", quality=IMAGE_QUALITY)
+    preprocessed = buffer.getvalue()
+    return preprocessed if len(preprocessed) < len(byte_stream) else byte_stream
 
 
 def is_animated_gif(image: bytes) -> bool:
@@ -453,7 +740,34 @@ def calculate_tokens(user_message: str, system_message: str) -> int:
     return tokens
 
 
-def get_usage(session_key: str) -> dict:
+def count_chat_tokens(user_message: str, assistant_message: str) -> int:
+    """
+    Counts the tokens in the user and assistant message of a chat.
+
+    Args:
+        user_message (str): The message sent by the user.
+        assistant_message (str): The message generated by the assistant.
+
+    Returns:
+        int: The number of tokens in both messages.
+    """
+    return len(encoding.encode(user_message)) + len(encoding.encode(assistant_message))
+
+
+def count_completion_tokens(assistant_message: str) -> int:
+    """
+    Counts the tokens in an assistant message, which is the number of completion tokens it was generated with.
+
+    Args:
+        assistant_message (str): The message generated by the assistant.
+
+    Returns:
+        int: The number of tokens in the message.
+    """
+    return len(encoding.encode(assistant_message))
+
+
+async def get_usage(session_key: str) -> dict:
     """
     Retrieves the usage statistics for the OpenAI API key.
 
@@ -467,12 +781,11 @@ def get_usage(session_key: str) -> dict:
     month = f"{month:02}"
     year = datetime.now().year
     last_day = monthrange(year, int(month))[1]
-    response = get(
+    async with http_client.get(
         f"https://api.openai.com/dashboard/billing/usage?end_date={year}-{month}-{last_day}&start_date={year}-{month}-01",
         headers={"Authorization": f"Bearer {session_key}"},
-    )
-    response.raise_for_status()
-    return response.json()
+    ) as response:
+        return await response.json()
 
 
 def get_server_id_and_name(ctx: commands.Context) -> Tuple[int, str]:
@@ -494,6 +807,33 @@ def get_server_id_and_name(ctx: commands.Context) -> Tuple[int, str]:
     return server_id, server_name
 
 
+def split_at_sentence_boundary(
+    message: str, limit: int = MESSAGE_LIMIT
+) -> Tuple[str, str]:
+    """
+    Splits a message in two at the last sentence boundary that keeps the first part within the limit.
+
+    If the first part has no sentence boundary, the message is split at the last space instead, or cut at the limit.
+
+    Args:
+        message (str): The message to split.
+        limit (int, optional): The maximum length of the first part. Defaults to MESSAGE_LIMIT.
+
+    Returns:
+        Tuple[str, str]: The first part, and the rest of the message. The rest is empty if the message fits the limit.
+    """
+    if len(message) <= limit:
+        return message, ""
+    window = message[:limit]
+    # Keep the punctuation with the sentence it ends
+    split = max(window.rfind(boundary) for boundary in SENTENCE_BOUNDARIES) + 1
+    if split <= 0:
+        split = window.rfind(" ")
+    if split <= 0:
+        split = limit
+    return message[:split].rstrip(), message[split:].lstrip()
+
+
 def split_message_by_sentence(message: str) -> list:
     """
     Splits a given message by sentence, into multiple messages with a maximum length of 2000 characters.
@@ -504,23 +844,11 @@ def split_message_by_sentence(message: str) -> list:
     Returns:
         list: A list of sentences, each with a maximum length of 2000 characters.
     """
-    sentences = message.split(". ")
-    current_length = 0
     messages = []
-    current_message = ""
-
-    for sentence in sentences:
-        if current_length + len(sentence) + 1 > 2000:  # +1 for the period
-            messages.append(current_message)
-            current_length = 0
-            current_message = ""
-
-        current_message += sentence + ". "
-        current_length += len(sentence) + 1
-
-    if current_message:  # Any leftover sentence
-        messages.append(current_message)
-
+    while message:
+        part, message = split_at_sentence_boundary(message)
+        if part:
+            messages.append(part)
     return messages
 
 
@@ -545,9 +873,7 @@ def guess_file_extension(
 
     Parameters:
     - file_path_or_stream (str | bytes): The filename or byte stream to determine the file type of.
-      If this is a string representing a filename, the function uses `Magic.from_file()`
-      to determine the file type. If this is a byte stream, the function uses
-      `Magic.from_buffer()` to determine the file type.
+      Common formats are recognized from their signature, anything else is determined with libmagic.
     - split_mime (bool): Whether to return the MIME type as a split tuple (type, subtype), instead of the file extension.
       Defaults to False.
 
@@ -560,11 +886,7 @@ def guess_file_extension(
     - guess_file_extension("image.png", split_mime=True) -> ("image", "png")
     - guess_file_extension(b"image data", split_mime=True) -> ("image", "png")
     """
-    mime = Magic(mime=True)
-    if isinstance(file_path_or_stream, bytes):
-        mime_type = mime.from_buffer(file_path_or_stream)
-    else:
-        mime_type = mime.from_file(file_path_or_stream)
+    mime_type = detect_mime_type(file_path_or_stream)
     if split_mime:
         return tuple(mime_type.split("/"))
     else:
@@ -721,3 +1043,102 @@ class DiscordHelper:
             bool: True if the user is a member of the guild, False otherwise.
         """
         return guild.get_member(user.id) is not None
+
+
+class GuildMembershipIndex:
+    """
+    An index of the guilds each user shares with the bot.
+
+    Kept up to date from the guild and member events, so finding the guilds of a user is a single lookup
+    instead of checking the members of every guild the bot is in.
+
+    Attributes:
+        user_guilds (dict[int, set[int]]): The IDs of the guilds each user ID is a member of.
+        guild_members (dict[int, set[int]]): The IDs of the members of each guild ID.
+
+    Methods:
+        rebuild(guilds): Rebuilds the index from the given guilds.
+        add_guild(guild): Adds all members of a guild to the index.
+        remove_guild(guild_id): Removes a guild and its members from the index.
+        add_member(user_id, guild_id): Adds a member of a guild to the index.
+        remove_member(user_id, guild_id): Removes a member of a guild from the index.
+        get_guild_ids(user_id): Gets the IDs of the guilds a user is a member of.
+    """
+
+    def __init__(self) -> None:
+        self.user_guilds: dict[int, set[int]] = {}
+        self.guild_members: dict[int, set[int]] = {}
+
+    def rebuild(self, guilds: list[Guild]) -> None:
+        """
+        Rebuilds the index from the given guilds.
+
+        Args:
+            guilds (list[discord.Guild]): The guilds the bot is in.
+        """
+        self.user_guilds = {}
+        self.guild_members = {}
+        for guild in guilds:
+            self.add_guild(guild)
+
+    def add_guild(self, guild: Guild) -> None:
+        """
+        Adds all members of a guild to the index.
+
+        Args:
+            guild (discord.Guild): The guild to add.
+        """
+        for member in guild.members:
+            self.add_member(member.id, guild.id)
+
+    def remove_guild(self, guild_id: int) -> None:
+        """
+        Removes a guild and its members from the index.
+
+        Args:
+            guild_id (int): The ID of the guild to remove.
+        """
+        for user_id in self.guild_members.pop(guild_id, set()):
+            guild_ids = self.user_guilds.get(user_id)
+            if guild_ids is not None:
+                guild_ids.discard(guild_id)
+                if not guild_ids:
+                    del self.user_guilds[user_id]
+
+    def add_member(self, user_id: int, guild_id: int) -> None:
+        """
+        Adds a member of a guild to the index.
+
+        Args:
+            user_id (int): The ID of the member.
+            guild_id (int): The ID of the guild.
+        """
+        self.user_guilds.setdefault(user_id, set()).add(guild_id)
+        self.guild_members.setdefault(guild_id, set()).add(user_id)
+
+    def remove_member(self, user_id: int, guild_id: int) -> None:
+        """
+        Removes a member of a guild from the index.
+
+        Args:
+            user_id (int): The ID of the member.
+            guild_id (int): The ID of the guild.
+        """
+        guild_ids = self.user_guilds.get(user_id)
+        if guild_ids is not None:
+            guild_ids.discard(guild_id)
+            if not guild_ids:
+                del self.user_guilds[user_id]
+        self.guild_members.get(guild_id, set()).discard(user_id)
+
+    def get_guild_ids(self, user_id: int) -> set[int]:
+        """
+        Gets the IDs of the guilds a user is a member of.
+
+        Args:
+            user_id (int): The ID of the user.
+
+        Returns:
+            set[int]: The IDs of the guilds the user is a member of.
+        """
+        return self.user_guilds.get(user_id, set())
@@ -2,11 +2,13 @@ import time
 import discord
 from discord.ext import commands
 from functools import wraps
+from inspect import iscoroutinefunction
 from textwrap import dedent
 
 from sql import database
 from sql import crud, schemas
 from cogs.utils._logger import timer_logger
+from cogs.utils.metrics import metrics
 
 TIMEOUT_IN_SECONDS = 60
 
@@ -144,20 +146,26 @@ def requires_tos_acceptance(func):
             )
             await view.wait()
             if view.value is True:
-                if user is None:
-                    await crud.add_user(
-                        database.AsyncSessionLocal,
-                        schemas.User.Add(
-                            user_id=ctx.author.id,
-                            username=ctx.author.name,
-                            agreed_to_tos=True,
-                        ),
-                    )
-                else:
-                    await crud.edit_user_tos(
-                        database.AsyncSessionLocal,
-                        schemas.User.SetTos(user_id=ctx.author.id, agreed_to_tos=True),
-                    )
+                # Check again in the same transaction, since the user may have been added while waiting for a response
+                async with crud.unit_of_work(database.AsyncSessionLocal) as session:
+                    if not await crud.check_user_exists(
+                        session, schemas.User.Get(user_id=ctx.author.id)
+                    ):
+                        await crud.add_user(
+                            session,
+                            schemas.User.Add(
+                                user_id=ctx.author.id,
+                                username=ctx.author.name,
+                                agreed_to_tos=True,
+                            ),
+                        )
+                    else:
+                        await crud.edit_user_tos(
+                            session,
+                            schemas.User.SetTos(
+                                user_id=ctx.author.id, agreed_to_tos=True
+                            ),
+                        )
                 return await func(*args, **kwargs)
             else:
                 return
@@ -201,6 +209,9 @@ def timeit(func):
     """
     A decorator that measures the execution time of a function.
 
+    Coroutine functions are timed until the awaited result is available, not just until the coroutine is created.
+    The elapsed time is recorded in the "crud_latency_seconds" histogram, labelled with the function name.
+
     Args:
         func: The function to be decorated.
 
@@ -208,15 +219,33 @@ def timeit(func):
         The decorated function.
 
     """
+    histogram = metrics.histogram("crud_latency_seconds", function=func.__name__)
 
-    def wrapper(*args, **kwargs):
-        start = time.perf_counter()
-        result = func(*args, **kwargs)
-        end = time.perf_counter()
-        elapsed_time = (end - start) * 1_000_000  # Convert to microseconds
+    def record(start: float):
+        elapsed_time = time.perf_counter() - start
+        histogram.observe(elapsed_time)
         timer_logger.debug(
-            f"CRUD function {func.__name__} took {round(elapsed_time, 5)} microseconds to execute."
+            f"CRUD function {func.__name__} took {round(elapsed_time * 1_000_000, 5)} microseconds to execute."
         )
-        return result
+
+    if iscoroutinefunction(func):
+
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                record(start)
+
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(start)
 
     return wrapper
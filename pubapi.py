@@ -2,13 +2,15 @@ import uvicorn
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from fastapi import FastAPI, HTTPException, status, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.requests import Request
 from pydantic import BaseModel
 from glob import glob
 from pathlib import Path
 
+from cogs.utils.metrics import metrics
+
 ABSOLUTE_PATH = "/var/www/aaaa/"
 
 limiter = Limiter(key_func=get_remote_address)
@@ -112,5 +114,19 @@ async def a(request: Request, search: AppendSearch = Depends(AppendSearch)):
         )
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+@limiter.limit("30/minute")
+async def prometheus_metrics(request: Request):
+    return PlainTextResponse(
+        metrics.render_prometheus(), media_type="text/plain; version=0.0.4"
+    )
+
+
+@app.get("/metrics/crud")
+@limiter.limit("10/minute")
+async def crud_metrics(request: Request):
+    return metrics.summarize("crud_latency_seconds", "function")
+
+
 def start_api():
     uvicorn.run(app, host="127.0.0.1", port=8000)
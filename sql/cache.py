@@ -0,0 +1,82 @@
+from typing import Iterable
+
+
+class AuthCache:
+    """
+    An in-process copy of the authorization and ban state stored in the database.
+
+    The global command checks run on every command invocation, so instead of querying the database each time,
+    the state is loaded once on startup and kept up to date by the CRUD functions that change it.
+
+    Attributes:
+        authorized_servers (set[int]): The IDs of all authorized servers.
+        banned_servers (set[int]): The IDs of all banned servers.
+        banned_users (set[int]): The IDs of all banned users.
+        is_loaded (bool): Whether the cache has been loaded from the database.
+
+    Methods:
+        load(authorized_servers, banned_servers, banned_users): Replaces the cached state.
+        set_server_authorized(server_id, is_authorized): Updates the authorization status of a server.
+        set_server_banned(server_id, is_banned): Updates the ban status of a server.
+        set_user_banned(user_id, is_banned): Updates the ban status of a user.
+        is_server_authorized(server_id): Checks if a server is authorized.
+        any_server_authorized(server_ids): Checks if any of the given servers is authorized.
+        is_server_banned(server_id): Checks if a server is banned.
+        is_user_banned(user_id): Checks if a user is banned.
+    """
+
+    def __init__(self) -> None:
+        self.authorized_servers: set[int] = set()
+        self.banned_servers: set[int] = set()
+        self.banned_users: set[int] = set()
+        self.is_loaded = False
+
+    def load(
+        self,
+        authorized_servers: Iterable[int],
+        banned_servers: Iterable[int],
+        banned_users: Iterable[int],
+    ) -> None:
+        """
+        Replaces the cached state with the given IDs.
+
+        Args:
+            authorized_servers (Iterable[int]): The IDs of all authorized servers.
+            banned_servers (Iterable[int]): The IDs of all banned servers.
+            banned_users (Iterable[int]): The IDs of all banned users.
+        """
+        self.authorized_servers = set(authorized_servers)
+        self.banned_servers = set(banned_servers)
+        self.banned_users = set(banned_users)
+        self.is_loaded = True
+
+    @staticmethod
+    def _update(ids: set[int], id: int, is_member: bool) -> None:
+        if is_member:
+            ids.add(id)
+        else:
+            ids.discard(id)
+
+    def set_server_authorized(self, server_id: int, is_authorized: bool) -> None:
+        self._update(self.authorized_servers, server_id, is_authorized)
+
+    def set_server_banned(self, server_id: int, is_banned: bool) -> None:
+        self._update(self.banned_servers, server_id, is_banned)
+
+    def set_user_banned(self, user_id: int, is_banned: bool) -> None:
+        self._update(self.banned_users, user_id, is_banned)
+
+    def is_server_authorized(self, server_id: int) -> bool:
+        return server_id in self.authorized_servers
+
+    def any_server_authorized(self, server_ids: Iterable[int]) -> bool:
+        return not self.authorized_servers.isdisjoint(server_ids)
+
+    def is_server_banned(self, server_id: int) -> bool:
+        return server_id in self.banned_servers
+
+    def is_user_banned(self, user_id: int) -> bool:
+        return user_id in self.banned_users
+
+
+auth_cache = AuthCache()
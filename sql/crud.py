@@ -1,9 +1,77 @@
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import AsyncIterator, Callable
+
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, or_, delete
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import select, or_, delete, exists, func, update
+from sqlalchemy.dialects import postgresql, sqlite
 
 from . import models, schemas
+from .cache import auth_cache
 from decorators import timeit
 
+# The dialect-specific INSERT constructs, which support ON CONFLICT clauses
+INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+# Key in AsyncSession.info marking a session as part of a unit of work.
+# Holds the callbacks to run once the unit of work has been committed.
+UNIT_OF_WORK = "unit_of_work"
+
+
+@asynccontextmanager
+async def unit_of_work(db: sessionmaker) -> AsyncIterator[AsyncSession]:
+    """
+    Runs several CRUD operations in a single session and transaction.
+
+    Any CRUD function given the yielded session reuses it instead of opening its own, and flushes instead of committing.
+    The transaction is committed once when the block exits, or rolled back if an exception is raised.
+
+    Args:
+        db (sessionmaker): The session factory.
+
+    Yields:
+        AsyncSession: The session to pass to the CRUD functions.
+
+    Example:
+        async with crud.unit_of_work(database.AsyncSessionLocal) as session:
+            await crud.add_server(session, ...)
+            await crud.add_chat(session, ...)
+    """
+    async with db() as session:
+        session.info[UNIT_OF_WORK] = []
+        async with session.begin():
+            yield session
+        for callback in session.info.pop(UNIT_OF_WORK):
+            callback()
+
+
+@asynccontextmanager
+async def _get_session(db: sessionmaker | AsyncSession) -> AsyncIterator[AsyncSession]:
+    """
+    Yields the session of a unit of work as is, or opens a new session from the session factory.
+    """
+    if isinstance(db, AsyncSession):
+        yield db
+    else:
+        async with db() as session:
+            yield session
+
+
+async def _commit(db: AsyncSession, *on_commit: Callable[[], None]) -> None:
+    """
+    Commits the session, then runs the given callbacks.
+
+    If the session is part of a unit of work, it is only flushed and the callbacks are deferred until the unit of work is committed.
+    """
+    if UNIT_OF_WORK in db.info:
+        await db.flush()
+        db.info[UNIT_OF_WORK].extend(on_commit)
+        return
+    await db.commit()
+    for callback in on_commit:
+        callback()
+
 
 @timeit
 async def get_current_revision(db: AsyncSession):
@@ -16,7 +84,7 @@ async def get_current_revision(db: AsyncSession):
     Returns:
         str: The current revision of the database.
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         result = await db.execute(select(models.AlembicVersion.version_num))
         return result.scalar_one_or_none()
 
@@ -33,7 +101,7 @@ async def check_user_exists(db: AsyncSession, user: schemas.User.Get):
     Returns:
         bool: True if the user exists, False otherwise.
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         result = await db.execute(
             select(models.User).where(models.User.user_id == user.user_id)
         )
@@ -52,7 +120,7 @@ async def check_server_exists(db: AsyncSession, server: schemas.Server.Get):
     Returns:
         bool: True if the server exists, False otherwise.
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         result = await db.execute(
             select(models.Server).where(models.Server.server_id == server.server_id)
         )
@@ -71,9 +139,11 @@ async def add_user(db: AsyncSession, user: schemas.User.Add):
     Returns:
     None
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         db.add(models.User(**user.model_dump()))
-        await db.commit()
+        await _commit(
+            db, partial(auth_cache.set_user_banned, user.user_id, user.is_banned)
+        )
 
 
 @timeit
@@ -88,13 +158,13 @@ async def edit_user_tos(db: AsyncSession, user: schemas.User.SetTos):
     Returns:
         None
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         result = await db.execute(
             select(models.User).where(models.User.user_id == user.user_id)
         )
         result = result.scalar_one_or_none()
         result.agreed_to_tos = user.agreed_to_tos
-        await db.commit()
+        await _commit(db)
 
 
 @timeit
@@ -109,13 +179,15 @@ async def edit_user_ban(db: AsyncSession, user: schemas.User.SetBan):
     Returns:
         None
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         result = await db.execute(
             select(models.User).where(models.User.user_id == user.user_id)
         )
         result = result.scalar_one_or_none()
         result.is_banned = user.is_banned
-        await db.commit()
+        await _commit(
+            db, partial(auth_cache.set_user_banned, user.user_id, user.is_banned)
+        )
 
 
 @timeit
@@ -130,7 +202,7 @@ async def get_user(db: AsyncSession, user: schemas.User.Get):
     Returns:
         models.User: The user object.
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         result = await db.execute(
             select(models.User).where(models.User.user_id == user.user_id)
         )
@@ -147,12 +219,20 @@ async def delete_all_user_data(db: AsyncSession, user: schemas.User.Delete):
         user (schemas.User.Delete): The user object to delete.
 
     Returns:
-        None
+        int: The number of chats deleted.
     """
-    async with db() as db:
-        await db.execute(delete(models.Chat).where(models.Chat.user_id == user.user_id))
-        await db.execute(delete(models.User).where(models.User.user_id == user.user_id))
-        await db.commit()
+    async with _get_session(db) as db:
+        result = await db.execute(
+            _delete_newest_chats([models.Chat.user_id == user.user_id], None)
+        )
+        await db.execute(
+            delete(models.User)
+            .where(models.User.user_id == user.user_id)
+            .execution_options(synchronize_session=False)
+        )
+        await _commit(db, partial(auth_cache.set_user_banned, user.user_id, False))
+
+        return result.rowcount
 
 
 @timeit
@@ -167,9 +247,42 @@ async def add_server(db: AsyncSession, server: schemas.Server.Add):
     Returns:
     None
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         db.add(models.Server(**server.model_dump()))
-        await db.commit()
+        await _commit(
+            db,
+            partial(
+                auth_cache.set_server_authorized, server.server_id, server.is_authorized
+            ),
+            partial(auth_cache.set_server_banned, server.server_id, server.is_banned),
+        )
+
+
+@timeit
+async def upsert_servers(db: AsyncSession, servers: list[schemas.Server.Add]):
+    """
+    Adds multiple servers to the database in a single statement and transaction.
+
+    Servers that already exist keep their authorization and ban status, but have their name updated if it changed.
+
+    Parameters:
+      db (AsyncSession): The database session.
+      servers (list[schemas.Server.Add]): The server data to be added or updated.
+
+    Returns:
+    None
+    """
+    if not servers:
+        return
+    async with _get_session(db) as db:
+        stmt = INSERTS[db.bind.dialect.name](models.Server)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[models.Server.server_id],
+            set_={"server_name": stmt.excluded.server_name},
+            where=models.Server.server_name != stmt.excluded.server_name,
+        )
+        await db.execute(stmt, [server.model_dump() for server in servers])
+        await _commit(db)
 
 
 @timeit
@@ -184,7 +297,7 @@ async def get_server(db: AsyncSession, server: schemas.Server.Get):
     Returns:
         models.Server: The server object.
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         result = await db.execute(
             select(models.Server).where(models.Server.server_id == server.server_id)
         )
@@ -203,9 +316,9 @@ async def add_chat(db: AsyncSession, chat: schemas.Chat.Add):
     Returns:
     None
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         db.add(models.Chat(**chat.model_dump()))
-        await db.commit()
+        await _commit(db)
 
 
 @timeit
@@ -220,7 +333,7 @@ async def get_chats_for_user(db: AsyncSession, chat: schemas.Chat.Get):
     Returns:
         List[models.Chat]: A list of chats.
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         if chat.n is None:
             result = await db.execute(
                 select(models.Chat.user_message, models.Chat.assistant_message)
@@ -253,7 +366,7 @@ async def get_shared_chats_for_server(db: AsyncSession, chat: schemas.Chat.Get):
     Returns:
         List[models.Chat]: A list of shared chats.
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         if chat.n is None:
             result = await db.execute(
                 select(models.Chat.user_message, models.Chat.assistant_message)
@@ -272,6 +385,146 @@ async def get_shared_chats_for_server(db: AsyncSession, chat: schemas.Chat.Get):
         return result.all()
 
 
+@timeit
+async def get_chat_history(db: AsyncSession, chat: schemas.Chat.History):
+    """
+    Retrieve a page of chat history, newest first, together with the cached token count of each chat.
+
+    The next page is retrieved by passing the id of the oldest chat in the previous page as before_id.
+
+    Args:
+        db (AsyncSession): The database session.
+        chat (schemas.Chat.History): The chat history to be retrieved. Shared chats are retrieved for the whole server.
+
+    Returns:
+        List[Row]: The id, user message, assistant message and token count of each chat.
+    """
+    filters = [
+        models.Chat.server_id == chat.server_id,
+        models.Chat.shared_chat == int(chat.shared_chat),
+    ]
+    if not chat.shared_chat:
+        filters.append(models.Chat.user_id == chat.user_id)
+    if chat.before_id is not None:
+        filters.append(models.Chat.id < chat.before_id)
+    async with _get_session(db) as db:
+        result = await db.execute(
+            select(
+                models.Chat.id,
+                models.Chat.user_message,
+                models.Chat.assistant_message,
+                models.Chat.token_count,
+            )
+            .where(*filters)
+            .order_by(models.Chat.id.desc())
+            .limit(chat.n)
+        )
+        return result.all()
+
+
+@timeit
+async def set_chat_token_counts(
+    db: AsyncSession, token_counts: list[schemas.Chat.TokenCount]
+):
+    """
+    Caches the token counts of chats, and their completion token counts if given, in a single bulk UPDATE.
+
+    Args:
+        db (AsyncSession): The database session.
+        token_counts (list[schemas.Chat.TokenCount]): The token counts of each chat.
+    """
+    async with _get_session(db) as db:
+        await db.execute(
+            update(models.Chat),
+            [token_count.model_dump(exclude_none=True) for token_count in token_counts],
+        )
+        await _commit(db)
+
+
+@timeit
+async def get_chats_without_token_counts(db: AsyncSession, n: int):
+    """
+    Retrieve the n oldest chats that are missing their token count or completion token count.
+
+    Args:
+        db (AsyncSession): The database session.
+        n (int): The maximum number of chats to retrieve.
+
+    Returns:
+        List[Row]: The id, user message and assistant message of each chat.
+    """
+    async with _get_session(db) as db:
+        result = await db.execute(
+            select(
+                models.Chat.id,
+                models.Chat.user_message,
+                models.Chat.assistant_message,
+            )
+            .where(
+                or_(
+                    models.Chat.token_count.is_(None),
+                    models.Chat.completion_tokens.is_(None),
+                )
+            )
+            .order_by(models.Chat.id)
+            .limit(n)
+        )
+        return result.all()
+
+
+@timeit
+async def get_chat_token_usage(
+    db: AsyncSession, server: schemas.Server.Get
+) -> schemas.Chat.Usage:
+    """
+    Sums up the token usage of all chats in a server, in a single aggregate query.
+
+    Chats without a reported usage are counted, but add no tokens.
+
+    Args:
+        db (AsyncSession): The database session.
+        server (schemas.Server.Get): The server to sum up the token usage of.
+
+    Returns:
+        schemas.Chat.Usage: The number of chats and the total prompt, completion and cached tokens.
+    """
+    async with _get_session(db) as db:
+        result = await db.execute(
+            select(
+                func.count(models.Chat.id).label("chats"),
+                func.coalesce(func.sum(models.Chat.prompt_tokens), 0).label(
+                    "prompt_tokens"
+                ),
+                func.coalesce(func.sum(models.Chat.completion_tokens), 0).label(
+                    "completion_tokens"
+                ),
+                func.coalesce(func.sum(models.Chat.cached_tokens), 0).label(
+                    "cached_tokens"
+                ),
+            ).where(models.Chat.server_id == server.server_id)
+        )
+        return schemas.Chat.Usage(**result.one()._asdict())
+
+
+def _delete_newest_chats(filters: list, n: int | None):
+    """
+    Builds a single DELETE statement for the n newest chats matching the filters, or all of them if n is None.
+
+    The rows are deleted in the database without being loaded into the session.
+    """
+    if n is None:
+        stmt = delete(models.Chat).where(*filters)
+    else:
+        newest_chats = (
+            select(models.Chat.id)
+            .where(*filters)
+            .order_by(models.Chat.id.desc())
+            .limit(n)
+        )
+        stmt = delete(models.Chat).where(models.Chat.id.in_(newest_chats))
+    return stmt.execution_options(synchronize_session=False)
+
+
 @timeit
 async def delete_chat(db: AsyncSession, chat: schemas.Chat.Delete) -> int:
     """
@@ -284,32 +537,20 @@ async def delete_chat(db: AsyncSession, chat: schemas.Chat.Delete) -> int:
     Returns:
         int: The number of chats deleted.
     """
-    async with db() as db:
-        if chat.n is None:
-            results = await db.execute(
-                select(models.Chat)
-                .where(models.Chat.user_id == chat.user_id)
-                .where(models.Chat.server_id == chat.server_id)
-                .where(models.Chat.shared_chat == 0)
-                .order_by(models.Chat.id.desc())
-            )
-        else:
-            results = await db.execute(
-                select(models.Chat)
-                .where(models.Chat.user_id == chat.user_id)
-                .where(models.Chat.server_id == chat.server_id)
-                .where(models.Chat.shared_chat == 0)
-                .order_by(models.Chat.id.desc())
-                .limit(chat.n)
+    async with _get_session(db) as db:
+        result = await db.execute(
+            _delete_newest_chats(
+                [
+                    models.Chat.user_id == chat.user_id,
+                    models.Chat.server_id == chat.server_id,
+                    models.Chat.shared_chat == 0,
+                ],
+                chat.n,
             )
-        results = results.scalars()
-        _count = 0
-        for result in results:
-            await db.delete(result)
-            _count += 1
-        await db.commit()
+        )
+        await _commit(db)
 
-        return _count
+        return result.rowcount
 
 
 @timeit
@@ -324,30 +565,19 @@ async def delete_shared_chat(db: AsyncSession, chat: schemas.Chat.Delete) -> int
     Returns:
         int: The number of shared chats deleted.
     """
-    async with db() as db:
-        if chat.n is None:
-            results = await db.execute(
-                select(models.Chat)
-                .where(models.Chat.server_id == chat.server_id)
-                .where(models.Chat.shared_chat == 1)
-                .order_by(models.Chat.id.desc())
-            )
-        else:
-            results = await db.execute(
-                select(models.Chat)
-                .where(models.Chat.server_id == chat.server_id)
-                .where(models.Chat.shared_chat == 1)
-                .order_by(models.Chat.id.desc())
-                .limit(chat.n)
+    async with _get_session(db) as db:
+        result = await db.execute(
+            _delete_newest_chats(
+                [
+                    models.Chat.server_id == chat.server_id,
+                    models.Chat.shared_chat == 1,
+                ],
+                chat.n,
             )
-        results = results.scalars()
-        _count = 0
-        for result in results:
-            await db.delete(result)
-            _count += 1
-        await db.commit()
+        )
+        await _commit(db)
 
-        return _count
+        return result.rowcount
 
 
 @timeit
@@ -361,7 +591,7 @@ async def get_authenticated_servers(db: AsyncSession):
     Returns:
         List[models.Server]: A list of authenticated servers.
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         result = await db.execute(
             select(models.Server.server_id).where(models.Server.is_authorized == 1)
         )
@@ -382,15 +612,12 @@ async def get_authenticated_server_by_id_or_name(
     Returns:
         models.Server: The authenticated server.
     """
-    async with db() as db:
-        result = await db.execute(
-            select(models.Server).where(
-                or_(
-                    models.Server.server_id == server.server_id_or_name,
-                    models.Server.server_name.like(f"%{server.server_id_or_name}%"),
-                )
-            )
-        )
+    # Only compare the ID when given one, since PostgreSQL can't compare an integer column with text
+    conditions = [models.Server.server_name.ilike(f"%{server.server_id_or_name}%")]
+    if isinstance(server.server_id_or_name, int):
+        conditions.append(models.Server.server_id == server.server_id_or_name)
+    async with _get_session(db) as db:
+        result = await db.execute(select(models.Server).where(or_(*conditions)))
         return result.scalar_one_or_none()
 
 
@@ -405,13 +632,99 @@ async def get_banned_servers(db: AsyncSession):
     Returns:
         List[models.Server]: A list of banned servers.
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         result = await db.execute(
             select(models.Server.server_id).where(models.Server.is_banned == 1)
         )
         return result.all()
 
 
+@timeit
+async def get_banned_users(db: AsyncSession):
+    """
+    Retrieves all banned users from the database.
+
+    Args:
+        db (AsyncSession): The database session.
+
+    Returns:
+        List[models.User]: A list of banned users.
+    """
+    async with _get_session(db) as db:
+        result = await db.execute(
+            select(models.User.user_id).where(models.User.is_banned == 1)
+        )
+        return result.all()
+
+
+@timeit
+async def load_auth_cache(db: AsyncSession):
+    """
+    Loads the authorized servers, banned servers and banned users into the in-memory authorization cache.
+
+    Args:
+        db (AsyncSession): The database session.
+
+    Returns:
+        None
+    """
+    async with _get_session(db) as db:
+        authorized_servers = await get_authenticated_servers(db)
+        banned_servers = await get_banned_servers(db)
+        banned_users = await get_banned_users(db)
+    auth_cache.load(
+        [server.server_id for server in authorized_servers],
+        [server.server_id for server in banned_servers],
+        [user.user_id for user in banned_users],
+    )
+
+
+@timeit
+async def get_command_check_status(db: AsyncSession, check: schemas.CommandCheck.Get):
+    """
+    Retrieves the ban and authorization status needed by the global command checks in a single query.
+
+    For servers, the authorization status is that of the server itself.
+    For DMs (server_id is None), the user is considered authorized if any of the given guilds is authorized.
+
+    Args:
+        db (AsyncSession): The database session.
+        check (schemas.CommandCheck.Get): The user, server and guilds to check.
+
+    Returns:
+        schemas.CommandCheck.Status: The ban and authorization status.
+    """
+    user_is_banned = (
+        select(models.User.is_banned)
+        .where(models.User.user_id == check.user_id)
+        .scalar_subquery()
+    )
+    server_is_banned = (
+        select(models.Server.is_banned)
+        .where(models.Server.server_id == check.server_id)
+        .scalar_subquery()
+    )
+    if check.server_id is None:
+        is_authorized = exists().where(
+            models.Server.server_id.in_(check.guild_ids),
+            models.Server.is_authorized == 1,
+        )
+    else:
+        is_authorized = exists().where(
+            models.Server.server_id == check.server_id,
+            models.Server.is_authorized == 1,
+        )
+    async with _get_session(db) as db:
+        result = await db.execute(
+            select(
+                func.coalesce(user_is_banned, 0).label("user_is_banned"),
+                func.coalesce(server_is_banned, 0).label("server_is_banned"),
+                is_authorized.label("is_authorized"),
+            )
+        )
+        return schemas.CommandCheck.Status(**result.one()._mapping)
+
+
 @timeit
 async def set_server_is_authorized(
     db: AsyncSession, server: schemas.Server.SetIsAuthorized
@@ -426,13 +739,18 @@ async def set_server_is_authorized(
     Returns:
         None
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         result = await db.execute(
             select(models.Server).where(models.Server.server_id == server.server_id)
         )
         result = result.scalar_one_or_none()
         result.is_authorized = server.is_authorized
-        await db.commit()
+        await _commit(
+            db,
+            partial(
+                auth_cache.set_server_authorized, server.server_id, server.is_authorized
+            ),
+        )
 
 
 @timeit
@@ -447,13 +765,16 @@ async def edit_server_ban(db: AsyncSession, server: schemas.Server.SetBan):
     Returns:
         None
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         result = await db.execute(
             select(models.Server).where(models.Server.server_id == server.server_id)
         )
         result = result.scalar_one_or_none()
         result.is_banned = server.is_banned
-        await db.commit()
+        await _commit(
+            db,
+            partial(auth_cache.set_server_banned, server.server_id, server.is_banned),
+        )
 
 
 @timeit
@@ -468,7 +789,7 @@ async def set_reboot(db: AsyncSession, bot: schemas.Bot.SetReboot):
     Returns:
         None
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         result = await db.execute(select(models.Bot))
         result = result.scalar_one_or_none()
         if result is None:
@@ -477,7 +798,7 @@ async def set_reboot(db: AsyncSession, bot: schemas.Bot.SetReboot):
             result.is_reboot_scheduled = bot.is_reboot_scheduled
             result.reboot_time = bot.reboot_time
             result.message_location = bot.message_location
-        await db.commit()
+        await _commit(db)
 
 
 @timeit
@@ -491,11 +812,11 @@ async def unset_reboot(db: AsyncSession):
     Returns:
         None
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         result = await db.execute(select(models.Bot))
         result = result.scalar_one_or_none()
         await db.delete(result)
-        await db.commit()
+        await _commit(db)
 
 
 @timeit
@@ -509,6 +830,6 @@ async def get_reboot_status(db: AsyncSession):
     Returns:
         models.Bot: The bot object with the reboot status.
     """
-    async with db() as db:
+    async with _get_session(db) as db:
         result = await db.execute(select(models.Bot))
         return result.scalar_one_or_none()
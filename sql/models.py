@@ -1,12 +1,25 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, PickleType
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Integer,
+    String,
+    ForeignKey,
+    DateTime,
+    PickleType,
+    Index,
+)
 from sqlalchemy.orm import relationship
 from .database import Base
 
+# Discord IDs don't fit in a 32-bit integer, which PostgreSQL's INTEGER is.
+# SQLite keeps INTEGER, since its integers are 64-bit and INTEGER PRIMARY KEY aliases the rowid.
+DiscordID = BigInteger().with_variant(Integer, "sqlite")
+
 
 class User(Base):
     __tablename__ = "users"
 
-    user_id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(DiscordID, primary_key=True, index=True)
     username = Column(String, nullable=False)
     agreed_to_tos = Column(Integer, nullable=False, default=0)
     is_banned = Column(Integer, nullable=False, default=0)
@@ -18,7 +31,7 @@ class User(Base):
 class Server(Base):
     __tablename__ = "servers"
 
-    server_id = Column(Integer, primary_key=True, index=True)
+    server_id = Column(DiscordID, primary_key=True, index=True)
     server_name = Column(String, nullable=False)
     is_authorized = Column(Integer, nullable=False, default=0)
     is_banned = Column(Integer, nullable=False, default=0)
@@ -31,16 +44,31 @@ class Chat(Base):
     __tablename__ = "chat"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.user_id"))
-    server_id = Column(Integer, ForeignKey("servers.server_id"))
+    user_id = Column(DiscordID, ForeignKey("users.user_id"))
+    server_id = Column(DiscordID, ForeignKey("servers.server_id"))
     user_message = Column(String, nullable=False)
     assistant_message = Column(String, nullable=False)
     shared_chat = Column(Integer, nullable=False, default=0)
+    # Tokens in the user and assistant message, counted once when the chat is first used as history
+    token_count = Column(Integer, nullable=True)
+    # The token usage reported by OpenAI for the response. Unknown for chats saved before it was stored
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    cached_tokens = Column(Integer, nullable=True)
 
     # Relationships
     user = relationship("User", back_populates="chats")
     server = relationship("Server", back_populates="chats")
 
+    # Chat history is looked up and cleared per user and server, or per server for shared chats,
+    # newest first. Including id lets SQLite walk the index in order instead of sorting.
+    __table_args__ = (
+        Index(
+            "ix_chat_user_server_shared", "user_id", "server_id", "shared_chat", "id"
+        ),
+        Index("ix_chat_server_shared", "server_id", "shared_chat", "id"),
+    )
+
 
 class Bot(Base):
     __tablename__ = "bot"
@@ -68,11 +68,42 @@ class Chat:
     class Add(_Base):
         user_message: str
         assistant_message: str
+        token_count: Optional[int] = None
+        prompt_tokens: Optional[int] = None
+        completion_tokens: Optional[int] = None
+        cached_tokens: Optional[int] = None
+
+    class History(_Base):
+        before_id: Optional[int] = None
+        n: int
+
+    class TokenCount(BaseModel):
+        id: int
+        token_count: int
+        completion_tokens: Optional[int] = None
+
+    class Usage(BaseModel):
+        chats: int
+        prompt_tokens: int
+        completion_tokens: int
+        cached_tokens: int
 
     class Delete(Get):
         pass
 
 
+class CommandCheck:
+    class Get(BaseModel):
+        user_id: int
+        server_id: Optional[int] = None
+        guild_ids: Optional[list[int]] = []
+
+    class Status(BaseModel):
+        user_is_banned: bool
+        server_is_banned: bool
+        is_authorized: bool
+
+
 class Bot:
     class _Base(BaseModel):
         is_reboot_scheduled: bool
@@ -0,0 +1,93 @@
+"""
+Shared setup for the test suite.
+
+The bot's own database engine is created when sql.database is imported, so DATABASE_URL is pointed at a throwaway
+SQLite database before anything imports it.
+
+The database tests run against both backends. PostgreSQL is taken from DATABASE_URL if it points at a PostgreSQL
+database, which should be one used only for testing, since its tables are dropped. Otherwise a throwaway container
+is started with testcontainers, if it and Docker are available, and the PostgreSQL tests are skipped if not.
+"""
+
+from os import environ
+from pathlib import Path
+from tempfile import mkdtemp
+
+import pytest
+from sqlalchemy import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+# The PostgreSQL database to test against, if DATABASE_URL points at one
+POSTGRES_URL = (
+    environ["DATABASE_URL"]
+    if environ.get("DATABASE_URL", "").startswith("postgresql")
+    else None
+)
+
+TEMP_DIR = Path(mkdtemp(prefix="quantumkat-tests-"))
+environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{TEMP_DIR / 'quantumkat.db'}"
+
+from sql import models  # noqa: E402
+from sql.cache import auth_cache  # noqa: E402
+from sql.database import SYNC_DRIVERS  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def postgres_url():
+    if POSTGRES_URL is not None:
+        yield POSTGRES_URL
+        return
+    try:
+        from testcontainers.postgres import PostgresContainer
+
+        container = PostgresContainer("postgres:16-alpine", driver="asyncpg")
+        container.start()
+    except Exception as e:
+        pytest.skip(f"No PostgreSQL database available: {e}")
+    try:
+        yield container.get_connection_url()
+    finally:
+        container.stop()
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def database_url(request, tmp_path):
+    """
+    The async URL of an empty database, once for each backend.
+    """
+    if request.param == "sqlite":
+        return f"sqlite+aiosqlite:///{tmp_path / 'quantumkat.db'}"
+    return request.getfixturevalue("postgres_url")
+
+
+@pytest.fixture
+def sync_database_url(database_url):
+    """
+    The URL of the same database with the blocking driver, which Alembic uses.
+    """
+    url = make_url(database_url)
+    return url.set(drivername=SYNC_DRIVERS[url.get_backend_name()]).render_as_string(
+        hide_password=False
+    )
+
+
+async def drop_tables(engine) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.drop_all)
+
+
+@pytest.fixture
+async def db(database_url):
+    """
+    A session factory for a database with all tables created, like the one the CRUD functions are given.
+    """
+    engine = create_async_engine(database_url)
+    await drop_tables(engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+    auth_cache.__init__()
+    yield sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    auth_cache.__init__()
+    await drop_tables(engine)
+    await engine.dispose()
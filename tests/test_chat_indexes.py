@@ -0,0 +1,104 @@
+"""
+Tests that the chat history queries search the chat indexes, instead of scanning the table or sorting.
+
+Query plans are specific to the database, so these run on SQLite, the default backend.
+"""
+
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from sql import crud, schemas
+
+USER_ID = 1
+SERVER_ID = 2
+
+pytestmark = pytest.mark.parametrize("database_url", ["sqlite"], indirect=True)
+
+HISTORY_QUERIES = [
+    (
+        "ix_chat_user_server_shared",
+        crud.get_chat_history,
+        schemas.Chat.History(server_id=SERVER_ID, user_id=USER_ID, n=20, before_id=50),
+    ),
+    (
+        "ix_chat_server_shared",
+        crud.get_chat_history,
+        schemas.Chat.History(
+            server_id=SERVER_ID, user_id=USER_ID, n=20, shared_chat=True
+        ),
+    ),
+    (
+        "ix_chat_user_server_shared",
+        crud.get_chats_for_user,
+        schemas.Chat.Get(server_id=SERVER_ID, user_id=USER_ID, n=10),
+    ),
+    (
+        "ix_chat_server_shared",
+        crud.get_shared_chats_for_server,
+        schemas.Chat.Get(server_id=SERVER_ID, user_id=USER_ID, n=10),
+    ),
+    (
+        "ix_chat_user_server_shared",
+        crud.delete_chat,
+        schemas.Chat.Delete(server_id=SERVER_ID, user_id=USER_ID, n=5),
+    ),
+    (
+        "ix_chat_server_shared",
+        crud.delete_shared_chat,
+        schemas.Chat.Delete(server_id=SERVER_ID, user_id=USER_ID, n=5),
+    ),
+]
+
+
+@contextmanager
+def capture_statements(engine):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record)
+
+
+async def get_query_plan(db, crud_function, schema) -> str:
+    engine = db.kw["bind"]
+    with capture_statements(engine) as statements:
+        await crud_function(db, schema)
+    (statement, parameters), *_ = statements
+    async with engine.connect() as conn:
+        result = await conn.exec_driver_sql(
+            f"EXPLAIN QUERY PLAN {statement}", parameters
+        )
+        return "\n".join(row[-1] for row in result.all())
+
+
+@pytest.mark.parametrize("index, crud_function, schema", HISTORY_QUERIES)
+async def test_history_queries_use_index_without_sorting(
+    db, index, crud_function, schema
+):
+    plan = await get_query_plan(db, crud_function, schema)
+
+    assert index in plan
+    assert "SCAN chat" not in plan
+    assert "TEMP B-TREE" not in plan
+
+
+async def test_history_queries_scan_the_table_without_the_indexes(db):
+    # Makes sure the plans above are checked meaningfully, since without the indexes the whole table is scanned
+    async with db.kw["bind"].begin() as conn:
+        await conn.exec_driver_sql("DROP INDEX ix_chat_user_server_shared")
+        await conn.exec_driver_sql("DROP INDEX ix_chat_server_shared")
+
+    plan = await get_query_plan(
+        db,
+        crud.get_chats_for_user,
+        schemas.Chat.Get(server_id=SERVER_ID, user_id=USER_ID, n=10),
+    )
+
+    assert "SCAN chat" in plan
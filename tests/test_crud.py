@@ -0,0 +1,271 @@
+"""
+Tests for the CRUD functions, run against both SQLite and PostgreSQL.
+"""
+
+from sql import crud, schemas
+from sql.cache import auth_cache
+
+# Discord IDs are 64-bit, and larger than PostgreSQL's INTEGER can hold
+USER_ID = 2**62 + 1
+OTHER_USER_ID = 2**62 + 2
+SERVER_ID = 2**62 + 3
+OTHER_SERVER_ID = 2**62 + 4
+
+
+async def add_users_and_servers(db):
+    # Chats reference their user and server, which PostgreSQL enforces
+    async with crud.unit_of_work(db) as session:
+        for user_id in (USER_ID, OTHER_USER_ID):
+            await crud.add_user(
+                session, schemas.User.Add(user_id=user_id, username=str(user_id))
+            )
+        await crud.upsert_servers(
+            session, [schemas.Server.Add(server_id=SERVER_ID, server_name="Server")]
+        )
+
+
+async def add_chats(db, server_id: int, user_id: int, count: int, shared=False):
+    for number in range(count):
+        await crud.add_chat(
+            db,
+            schemas.Chat.Add(
+                server_id=server_id,
+                user_id=user_id,
+                shared_chat=shared,
+                user_message=f"Question {number}",
+                assistant_message=f"Answer {number}",
+            ),
+        )
+
+
+async def test_large_discord_ids_round_trip(db):
+    await crud.add_user(db, schemas.User.Add(user_id=USER_ID, username="user"))
+    await crud.add_server(
+        db, schemas.Server.Add(server_id=SERVER_ID, server_name="Server")
+    )
+
+    user = await crud.get_user(db, schemas.User.Get(user_id=USER_ID))
+    server = await crud.get_server(db, schemas.Server.Get(server_id=SERVER_ID))
+    assert user.user_id == USER_ID
+    assert server.server_id == SERVER_ID
+
+
+async def test_upsert_servers_updates_names_and_keeps_status(db):
+    await crud.upsert_servers(
+        db, [schemas.Server.Add(server_id=SERVER_ID, server_name="Old name")]
+    )
+    await crud.set_server_is_authorized(
+        db, schemas.Server.SetIsAuthorized(server_id=SERVER_ID, is_authorized=True)
+    )
+
+    await crud.upsert_servers(
+        db,
+        [
+            schemas.Server.Add(server_id=SERVER_ID, server_name="New name"),
+            schemas.Server.Add(server_id=OTHER_SERVER_ID, server_name="Other"),
+        ],
+    )
+
+    server = await crud.get_server(db, schemas.Server.Get(server_id=SERVER_ID))
+    assert server.server_name == "New name"
+    assert server.is_authorized == 1
+    assert await crud.check_server_exists(
+        db, schemas.Server.Get(server_id=OTHER_SERVER_ID)
+    )
+
+
+async def test_get_authenticated_server_by_id_or_name(db):
+    await crud.add_server(
+        db,
+        schemas.Server.Add(
+            server_id=SERVER_ID, server_name="Quantum Lounge", is_authorized=True
+        ),
+    )
+
+    by_name = await crud.get_authenticated_server_by_id_or_name(
+        db, schemas.Server.GetByIdOrName(server_id_or_name="quantum lounge")
+    )
+    by_id = await crud.get_authenticated_server_by_id_or_name(
+        db, schemas.Server.GetByIdOrName(server_id_or_name=SERVER_ID)
+    )
+    assert by_name.server_id == SERVER_ID
+    assert by_id.server_id == SERVER_ID
+
+
+async def test_get_command_check_status_for_unknown_user_and_server(db):
+    status = await crud.get_command_check_status(
+        db, schemas.CommandCheck.Get(user_id=USER_ID, server_id=SERVER_ID)
+    )
+
+    assert status == schemas.CommandCheck.Status(
+        user_is_banned=False, server_is_banned=False, is_authorized=False
+    )
+
+
+async def test_get_command_check_status_for_banned_user_and_server(db):
+    await crud.add_user(
+        db, schemas.User.Add(user_id=USER_ID, username="user", is_banned=True)
+    )
+    await crud.add_server(
+        db,
+        schemas.Server.Add(
+            server_id=SERVER_ID,
+            server_name="Server",
+            is_authorized=True,
+            is_banned=True,
+        ),
+    )
+
+    status = await crud.get_command_check_status(
+        db, schemas.CommandCheck.Get(user_id=USER_ID, server_id=SERVER_ID)
+    )
+
+    assert status == schemas.CommandCheck.Status(
+        user_is_banned=True, server_is_banned=True, is_authorized=True
+    )
+
+
+async def test_get_command_check_status_in_dms(db):
+    await crud.upsert_servers(
+        db,
+        [
+            schemas.Server.Add(
+                server_id=SERVER_ID, server_name="Authorized", is_authorized=True
+            ),
+            schemas.Server.Add(server_id=OTHER_SERVER_ID, server_name="Unauthorized"),
+        ],
+    )
+
+    authorized = await crud.get_command_check_status(
+        db,
+        schemas.CommandCheck.Get(
+            user_id=USER_ID, guild_ids=[SERVER_ID, OTHER_SERVER_ID]
+        ),
+    )
+    unauthorized = await crud.get_command_check_status(
+        db, schemas.CommandCheck.Get(user_id=USER_ID, guild_ids=[OTHER_SERVER_ID])
+    )
+    no_guilds = await crud.get_command_check_status(
+        db, schemas.CommandCheck.Get(user_id=USER_ID, guild_ids=[])
+    )
+
+    assert authorized.is_authorized
+    assert not unauthorized.is_authorized
+    assert not no_guilds.is_authorized
+
+
+async def test_load_auth_cache(db):
+    await crud.add_user(
+        db, schemas.User.Add(user_id=USER_ID, username="user", is_banned=True)
+    )
+    await crud.add_server(
+        db,
+        schemas.Server.Add(
+            server_id=SERVER_ID, server_name="Server", is_authorized=True
+        ),
+    )
+    auth_cache.__init__()
+
+    await crud.load_auth_cache(db)
+
+    assert auth_cache.is_loaded
+    assert auth_cache.is_user_banned(USER_ID)
+    assert auth_cache.is_server_authorized(SERVER_ID)
+    assert not auth_cache.is_server_banned(SERVER_ID)
+
+
+async def test_unit_of_work_rolls_back_and_skips_cache_updates(db):
+    try:
+        async with crud.unit_of_work(db) as session:
+            await crud.add_server(
+                session,
+                schemas.Server.Add(
+                    server_id=SERVER_ID, server_name="Server", is_authorized=True
+                ),
+            )
+            raise RuntimeError
+    except RuntimeError:
+        pass
+
+    assert not await crud.check_server_exists(
+        db, schemas.Server.Get(server_id=SERVER_ID)
+    )
+    assert not auth_cache.is_server_authorized(SERVER_ID)
+
+
+async def test_chat_history_pages_newest_first(db):
+    await add_users_and_servers(db)
+    await add_chats(db, SERVER_ID, USER_ID, 5)
+    await add_chats(db, SERVER_ID, OTHER_USER_ID, 2)
+
+    first_page = await crud.get_chat_history(
+        db, schemas.Chat.History(server_id=SERVER_ID, user_id=USER_ID, n=3)
+    )
+    second_page = await crud.get_chat_history(
+        db,
+        schemas.Chat.History(
+            server_id=SERVER_ID, user_id=USER_ID, n=3, before_id=first_page[-1].id
+        ),
+    )
+
+    assert [chat.user_message for chat in first_page + second_page] == [
+        f"Question {number}" for number in reversed(range(5))
+    ]
+
+
+async def test_delete_chat_deletes_newest_chats(db):
+    await add_users_and_servers(db)
+    await add_chats(db, SERVER_ID, USER_ID, 5)
+    await add_chats(db, SERVER_ID, USER_ID, 2, shared=True)
+
+    deleted = await crud.delete_chat(
+        db, schemas.Chat.Delete(server_id=SERVER_ID, user_id=USER_ID, n=2)
+    )
+    remaining = await crud.get_chats_for_user(
+        db, schemas.Chat.Get(server_id=SERVER_ID, user_id=USER_ID)
+    )
+    deleted_shared = await crud.delete_shared_chat(
+        db, schemas.Chat.Delete(server_id=SERVER_ID, user_id=USER_ID)
+    )
+
+    assert deleted == 2
+    assert [chat.user_message for chat in remaining] == [
+        "Question 2",
+        "Question 1",
+        "Question 0",
+    ]
+    assert deleted_shared == 2
+
+
+async def test_chat_token_counts_and_usage(db):
+    await add_users_and_servers(db)
+    await crud.add_chat(
+        db,
+        schemas.Chat.Add(
+            server_id=SERVER_ID,
+            user_id=USER_ID,
+            user_message="Question",
+            assistant_message="Answer",
+            token_count=2,
+            prompt_tokens=100,
+            completion_tokens=20,
+            cached_tokens=50,
+        ),
+    )
+    await add_chats(db, SERVER_ID, USER_ID, 1)
+
+    missing = await crud.get_chats_without_token_counts(db, 10)
+    await crud.set_chat_token_counts(
+        db,
+        [
+            schemas.Chat.TokenCount(id=chat.id, token_count=4, completion_tokens=2)
+            for chat in missing
+        ],
+    )
+    usage = await crud.get_chat_token_usage(db, schemas.Server.Get(server_id=SERVER_ID))
+
+    assert len(missing) == 1
+    assert await crud.get_chats_without_token_counts(db, 10) == []
+    assert usage == schemas.Chat.Usage(
+        chats=2, prompt_tokens=100, completion_tokens=22, cached_tokens=50
+    )
@@ -0,0 +1,103 @@
+"""
+Tests for the global command check, for commands run in DMs.
+"""
+
+from os import environ
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+from cogs.utils.utils import GuildMembershipIndex
+from sql import crud, schemas
+from sql.cache import auth_cache
+
+# QuantumKat.py reads the owner from the environment and the bot token from 1Password when it is imported
+environ.setdefault("OWNER_ID", "1")
+with patch("cogs.utils.utils.get_field_from_1password", return_value="token"):
+    import QuantumKat
+
+USER_ID = 100
+AUTHORIZED_GUILD_ID = 200
+UNAUTHORIZED_GUILD_ID = 300
+
+
+class DMContext:
+    """
+    The parts of a commands.Context the global check uses, for a command sent in a DM.
+    """
+
+    def __init__(self, user_id: int) -> None:
+        self.author = SimpleNamespace(id=user_id)
+        self.guild = None
+        self.command = SimpleNamespace(name="chat")
+        self.replies = []
+
+    async def reply(self, content: str, **kwargs) -> None:
+        self.replies.append(content)
+
+
+@pytest.fixture(autouse=True)
+async def bot_state(db, monkeypatch):
+    for server in (
+        schemas.Server.Add(
+            server_id=AUTHORIZED_GUILD_ID, server_name="Authorized", is_authorized=True
+        ),
+        schemas.Server.Add(server_id=UNAUTHORIZED_GUILD_ID, server_name="Unauthorized"),
+    ):
+        await crud.add_server(db, server)
+    # The global check falls back to the database while the authorization cache is not loaded
+    monkeypatch.setattr(QuantumKat, "AsyncSessionLocal", db)
+    monkeypatch.setattr(QuantumKat.bot, "membership_index", GuildMembershipIndex())
+    auth_cache.__init__()
+
+
+def load_cache() -> None:
+    auth_cache.load(
+        authorized_servers=[AUTHORIZED_GUILD_ID], banned_servers=[], banned_users=[]
+    )
+
+
+@pytest.mark.parametrize("cache_loaded", [True, False])
+async def test_dm_allowed_for_member_of_authorized_server(cache_loaded):
+    if cache_loaded:
+        load_cache()
+    QuantumKat.bot.membership_index.add_member(USER_ID, AUTHORIZED_GUILD_ID)
+    ctx = DMContext(USER_ID)
+
+    assert await QuantumKat.global_check(ctx) is True
+    assert ctx.replies == []
+
+
+@pytest.mark.parametrize("cache_loaded", [True, False])
+async def test_dm_rejected_without_authorized_server(cache_loaded):
+    if cache_loaded:
+        load_cache()
+    QuantumKat.bot.membership_index.add_member(USER_ID, UNAUTHORIZED_GUILD_ID)
+    ctx = DMContext(USER_ID)
+
+    with pytest.raises(QuantumKat.GlobalCheckFailure) as failure:
+        await QuantumKat.global_check(ctx)
+    assert failure.value.check == "dm_not_authenticated"
+    assert ctx.replies == [QuantumKat.CHECK_FAILURE_MESSAGES["dm_not_authenticated"]]
+
+
+@pytest.mark.parametrize("cache_loaded", [True, False])
+async def test_dm_rejected_for_user_in_no_shared_server(cache_loaded):
+    if cache_loaded:
+        load_cache()
+    ctx = DMContext(USER_ID)
+
+    with pytest.raises(QuantumKat.GlobalCheckFailure) as failure:
+        await QuantumKat.global_check(ctx)
+    assert failure.value.check == "dm_not_authenticated"
+
+
+async def test_dm_check_does_not_scan_guild_members():
+    load_cache()
+    QuantumKat.bot.membership_index.add_member(USER_ID, AUTHORIZED_GUILD_ID)
+
+    with patch.object(
+        QuantumKat.DiscordHelper, "user_in_guild", side_effect=AssertionError
+    ):
+        assert await QuantumKat.global_check(DMContext(USER_ID)) is True
@@ -0,0 +1,40 @@
+"""
+Tests that the image pipeline recovers when its worker processes die.
+"""
+
+import os
+from pathlib import Path
+
+import pytest
+
+from cogs.utils.image_pipeline import ImagePipeline, ImagePipelineError
+
+
+def crash() -> None:
+    os._exit(1)
+
+
+def crash_once(marker: str) -> str:
+    # Dies the first time it runs, like a worker killed while handling a large image
+    if not Path(marker).exists():
+        Path(marker).touch()
+        os._exit(1)
+    return "done"
+
+
+@pytest.fixture
+async def pipeline():
+    pipeline = ImagePipeline(workers=1, max_pending_jobs=2)
+    yield pipeline
+    pipeline.shutdown()
+
+
+async def test_restarts_the_workers_and_retries_the_job(pipeline, tmp_path):
+    assert await pipeline.run(crash_once, str(tmp_path / "crashed")) == "done"
+
+
+async def test_gives_up_when_the_job_keeps_killing_the_workers(pipeline):
+    with pytest.raises(ImagePipelineError):
+        await pipeline.run(crash)
+    # The broken workers have been replaced, so later jobs still run
+    assert await pipeline.run(abs, -1) == 1
@@ -0,0 +1,87 @@
+"""
+Tests for the Alembic migrations, run against both SQLite and PostgreSQL.
+"""
+
+from pathlib import Path
+
+import pytest
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import BigInteger, Integer, create_engine, inspect
+
+from sql import models
+
+ALEMBIC_DIR = Path(__file__).parent.parent / "alembic"
+
+# The revision before Discord IDs were made 64-bit
+BEFORE_BIGINT_REVISION = "7c1f4e2a9d3b"
+
+DISCORD_ID_COLUMNS = [
+    ("users", "user_id"),
+    ("servers", "server_id"),
+    ("chat", "user_id"),
+    ("chat", "server_id"),
+]
+
+
+@pytest.fixture
+def engine(sync_database_url):
+    engine = create_engine(sync_database_url)
+    models.Base.metadata.drop_all(engine)
+    yield engine
+    models.Base.metadata.drop_all(engine)
+    engine.dispose()
+
+
+def migrate(engine, action: str, revision: str) -> None:
+    # No config file is given, so env.py leaves the logging configuration of the tests alone
+    config = Config()
+    config.set_main_option("script_location", str(ALEMBIC_DIR))
+    with engine.begin() as connection:
+        config.attributes["connection"] = connection
+        getattr(command, action)(config, revision)
+
+
+def get_column_types(engine, table: str) -> dict:
+    return {
+        column["name"]: column["type"] for column in inspect(engine).get_columns(table)
+    }
+
+
+def test_upgrade_creates_the_model_schema(engine):
+    migrate(engine, "upgrade", "head")
+
+    for table in ("users", "servers", "chat"):
+        assert set(get_column_types(engine, table)) == set(
+            models.Base.metadata.tables[table].columns.keys()
+        )
+    assert {index["name"] for index in inspect(engine).get_indexes("chat")} >= {
+        "ix_chat_user_server_shared",
+        "ix_chat_server_shared",
+    }
+
+
+def test_discord_id_columns_are_64_bit(engine):
+    migrate(engine, "upgrade", "head")
+
+    # SQLite's INTEGER is already 64-bit, so only PostgreSQL's columns are changed
+    expected_type = Integer if engine.dialect.name == "sqlite" else BigInteger
+    for table, column in DISCORD_ID_COLUMNS:
+        assert isinstance(get_column_types(engine, table)[column], expected_type)
+
+
+def test_downgrading_discord_ids_restores_integer_columns(engine):
+    migrate(engine, "upgrade", "head")
+    migrate(engine, "downgrade", BEFORE_BIGINT_REVISION)
+
+    for table, column in DISCORD_ID_COLUMNS:
+        column_type = get_column_types(engine, table)[column]
+        assert isinstance(column_type, Integer)
+        assert not isinstance(column_type, BigInteger)
+
+
+def test_downgrade_to_base_removes_all_tables(engine):
+    migrate(engine, "upgrade", "head")
+    migrate(engine, "downgrade", "base")
+
+    assert set(inspect(engine).get_table_names()) <= {"alembic_version"}